@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import argparse
+import fnmatch
+import gc
+import json
+import logging
+import resource
+import timeit
+from datetime import datetime
+
+from typing import List, Dict
+
+from benchmarks import stubs
+from benchmarks.payloads import create_payload
+from plugins.gipod.bizz import validate_and_clean_data, get_data_hash, create_geometry_levels, create_map_item, \
+    convert_to_item_tos, convert_search_hits_to_item_tos, convert_to_item_details_to, get_geometry_tos, \
+    get_item_geometries, set_item_periods, pack_item_geometries, _clean_coordinates
+from plugins.gipod.bizz.gipod import re_index_model, _update_many
+from plugins.gipod.bizz.search import get_search_backend
+from plugins.gipod.models import BaseModel, WorkAssignment, Manifestation
+from plugins.gipod.to import GeometryFormat
+
+
+class Benchmark(object):
+    # `prepare` creates the input for one round and isn't measured, `run` processes that input
+
+    def __init__(self, name, run, prepare=None):
+        self.name = name
+        self.run = run
+        self.prepare = prepare or (lambda: None)
+
+
+class Result(object):
+
+    def __init__(self, name, item_count, durations, objects):
+        self.name = name
+        self.item_count = item_count
+        self.durations = durations
+        self.objects = objects
+
+    @property
+    def items_per_second(self):
+        return self.item_count / min(self.durations)
+
+    @property
+    def ms_per_item(self):
+        return min(self.durations) * 1000 / self.item_count
+
+    @property
+    def objects_per_item(self):
+        return float(min(self.objects)) / self.item_count
+
+    def to_dict(self):
+        return {
+            'items_per_second': self.items_per_second,
+            'ms_per_item': self.ms_per_item,
+            'objects_per_item': self.objects_per_item,
+        }
+
+
+def measure(benchmark, item_count, rounds):
+    # type: (Benchmark, int, int) -> Result
+    # Objects are the gc tracked objects (lists, dicts, instances, ...) that were created and not freed during a round.
+    # The garbage collector is disabled while measuring, so this also counts garbage that is only freed by a collection.
+    durations = []
+    objects = []
+    for _ in xrange(rounds):
+        state = benchmark.prepare()
+        gc.collect()
+        gc.disable()
+        try:
+            objects_before = gc.get_count()[0]
+            start = timeit.default_timer()
+            benchmark.run(state)
+            durations.append(timeit.default_timer() - start)
+            objects.append(gc.get_count()[0] - objects_before)
+        finally:
+            gc.enable()
+    return Result(benchmark.name, item_count, durations, objects)
+
+
+def get_benchmarks(item_count, seed):
+    # type: (int, int) -> List[Benchmark]
+    # One in three items is a manifestation
+    ids = [(BaseModel.TYPE_MANIFESTATION if i % 3 == 0 else BaseModel.TYPE_WORK_ASSIGNMENT, i)
+           for i in xrange(1, item_count + 1)]
+    payloads = [(type_, '%s-%s' % (type_, gipod_id), json.dumps(create_payload(type_, gipod_id, seed)))
+                for type_, gipod_id in ids]
+
+    def load_payloads():
+        return [(type_, uid, json.loads(payload)) for type_, uid, payload in payloads]
+
+    models = []
+    for type_, uid, data in load_payloads():
+        validate_and_clean_data(type_, uid, data)
+        clazz = Manifestation if type_ == BaseModel.TYPE_MANIFESTATION else WorkAssignment
+        model = clazz(key=clazz.create_key(type_, uid.split('-')[1]),
+                      data=data,
+                      data_hash=get_data_hash(data),
+                      geometry_levels=create_geometry_levels(data))
+        set_item_periods(model)
+        pack_item_geometries(model)
+        models.append(model)
+    map_items = [create_map_item(model) for model in models]
+    hits = []
+    for model in models:
+        _, _, operations = re_index_model(model)
+        operations = list(operations)
+        if 'index' in operations[0]:
+            hits.append((model.uid, operations[1]))
+    current_date = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def run_clean_data(data_list):
+        for type_, uid, data in data_list:
+            validate_and_clean_data(type_, uid, data)
+
+    def run_clean_coordinates(data_list):
+        for _, _, data in data_list:
+            _clean_coordinates(data['location']['geometry'].get('coordinates') or [])
+
+    def run_re_index(_):
+        for model in models:
+            _, _, operations = re_index_model(model)
+            list(operations)
+
+    def run_geometry_tos(geometry_format):
+        def run(_):
+            for model in models:
+                location_geometry, _ = get_item_geometries(model)
+                get_geometry_tos(model.uid, location_geometry, '#000000', geometry_format)
+        return run
+
+    def run_details(geometry_format, tolerance=None):
+        def run(_):
+            for model in models:
+                convert_to_item_details_to(model.uid, model, current_date, tolerance, geometry_format)
+        return run
+
+    sync_round = [0]
+
+    def prepare_sync():
+        # New ids every round, so every item is created and indexed
+        sync_round[0] += 1
+        get_search_backend().execute_bulk_request([])
+        offset = sync_round[0] * item_count
+        return [(type_, str(offset + gipod_id)) for type_, gipod_id in ids]
+
+    def run_sync(items):
+        for type_ in (BaseModel.TYPE_WORK_ASSIGNMENT, BaseModel.TYPE_MANIFESTATION):
+            _update_many(type_, [gipod_id for t, gipod_id in items if t == type_])
+
+    return [
+        Benchmark('validate_and_clean_data', run_clean_data, load_payloads),
+        Benchmark('clean_coordinates', run_clean_coordinates, load_payloads),
+        Benchmark('re_index_model', run_re_index),
+        Benchmark('convert_to_item_tos', lambda _: convert_to_item_tos(map_items)),
+        Benchmark('convert_search_hits_to_item_tos', lambda _: list(convert_search_hits_to_item_tos(hits))),
+        Benchmark('get_geometry_tos', run_geometry_tos(GeometryFormat.COORDINATES)),
+        Benchmark('get_geometry_tos[polyline]', run_geometry_tos(GeometryFormat.ENCODED_POLYLINE)),
+        Benchmark('convert_to_item_details_to', run_details(GeometryFormat.COORDINATES)),
+        Benchmark('convert_to_item_details_to[polyline]', run_details(GeometryFormat.ENCODED_POLYLINE)),
+        Benchmark('convert_to_item_details_to[zoom 14]', run_details(GeometryFormat.COORDINATES, 0.0001)),
+        Benchmark('sync', run_sync, prepare_sync),
+    ]
+
+
+def print_results(results, baseline):
+    # type: (List[Result], Dict[str, Dict]) -> None
+    print '%-40s %12s %10s %12s %10s' % ('benchmark', 'items/s', 'ms/item', 'objects/item', 'change')
+    for result in results:
+        change = ''
+        if result.name in baseline:
+            previous = baseline[result.name]['ms_per_item']
+            change = '%+.1f%%' % ((result.ms_per_item - previous) / previous * 100)
+        print '%-40s %12.1f %10.3f %12.1f %10s' % (result.name, result.items_per_second, result.ms_per_item,
+                                                   result.objects_per_item, change)
+    print 'Peak memory: %.1f MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the conversion, cleaning and indexing of gipod items')
+    parser.add_argument('--items', type=int, default=200, help='amount of synthetic items')
+    parser.add_argument('--rounds', type=int, default=5, help='the fastest round is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic items')
+    parser.add_argument('--only', action='append', help='only run the benchmarks matching this pattern')
+    parser.add_argument('--save', help='save the results as json to this file')
+    parser.add_argument('--compare', help='compare with the results saved in this file')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    bed = stubs.activate(args.seed)
+    try:
+        benchmarks = get_benchmarks(args.items, args.seed)
+        if args.only:
+            benchmarks = [b for b in benchmarks if any(fnmatch.fnmatch(b.name, pattern) for pattern in args.only)]
+        results = [measure(benchmark, args.items, args.rounds) for benchmark in benchmarks]
+    finally:
+        bed.deactivate()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({result.name: result.to_dict() for result in results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import math
+import random
+from datetime import datetime, timedelta
+
+# Synthetic GIPOD api responses. Items are generated from their type and id so the same item is returned every time
+# it is requested, like the real api does.
+
+EVENT_TYPES = ['(Werf)kraan', 'Betoging', 'Container/Werfkeet', 'Feest/Kermis', 'Markt', 'Speelstraat',
+               'Sportwedstrijd', 'Stelling', 'Terras', 'Verhuislift', 'Wielerwedstrijd - open criterium']
+EFFECTS = ['Rijstrookversmalling', 'Afgesloten voor doorgaand verkeer', 'Fietspad afgesloten', 'Voetpad afgesloten',
+           'Parkeerverbod', 'Omleiding voor bussen']
+STREETS = ['Kerkstraat', 'Stationsstraat', 'Dorpsstraat', 'Molenstraat', 'Schoolstraat', 'Nieuwstraat', 'Kapelstraat',
+           'Beekstraat', 'Veldstraat', 'Industrieweg']
+
+# Bounding box of Flanders
+MIN_LAT, MAX_LAT = 50.68, 51.50
+MIN_LON, MAX_LON = 2.54, 5.91
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+class Profile(object):
+
+    def __init__(self, name, weight, periods, polygons, vertices, diversions, diversion_vertices):
+        self.name = name
+        self.weight = weight
+        self.periods = periods
+        self.polygons = polygons
+        self.vertices = vertices
+        self.diversions = diversions
+        self.diversion_vertices = diversion_vertices
+
+
+# Every profile is a (min, max) range, the weights roughly match the items on the real api
+PROFILES = [
+    Profile('work_assignment', 60, (1, 1), (1, 1), (5, 60), (0, 1), (5, 40)),
+    Profile('manifestation', 25, (1, 60), (1, 2), (5, 100), (0, 2), (10, 100)),
+    Profile('large_manifestation', 10, (50, 400), (2, 6), (200, 1000), (1, 4), (100, 500)),
+    Profile('huge_work_assignment', 5, (1, 1), (2, 4), (1000, 2000), (2, 4), (300, 1000)),
+]
+
+
+def create_payload(type_, gipod_id, seed=0):
+    # type: (str, int, int) -> dict
+    rnd = random.Random('%s-%s-%s' % (seed, type_, gipod_id))
+    profile = _get_profile(rnd, type_)
+    lat = rnd.uniform(MIN_LAT, MAX_LAT)
+    lon = rnd.uniform(MIN_LON, MAX_LON)
+    # Relative to today, so most items have periods that haven't ended yet and are indexed like current items are
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    start_date = today + timedelta(days=rnd.randint(-60, 365), hours=rnd.randint(6, 20))
+    data = {
+        'gipodId': gipod_id,
+        'description': 'Synthetisch item %s %s in de %s' % (type_, gipod_id, rnd.choice(STREETS)),
+        'type': rnd.choice(['Rioleringswerken', 'Wegeniswerken', 'Nutswerken', None]),
+        'contactDetails': {
+            'organisation': rnd.choice(['Stad Gent', 'Fluvius', 'De Watergroep', 'Proximus', None]),
+        },
+        'hindrance': {
+            'important': rnd.random() < 0.3,
+            'effects': rnd.sample(EFFECTS, rnd.randint(0, 4)),
+        },
+        'location': {
+            'coordinate': {
+                'type': 'Point',
+                'coordinates': [lon, lat],
+            },
+            'geometry': _create_location_geometry(rnd, lat, lon, profile),
+        },
+        'diversions': [_create_diversion(rnd, lat, lon, profile) for _ in xrange(_randint(rnd, profile.diversions))],
+    }
+    if type_ == 'm':
+        data['eventType'] = rnd.choice(EVENT_TYPES)
+        data['periods'] = _create_periods(rnd, start_date, _randint(rnd, profile.periods))
+    else:
+        end_date = start_date + timedelta(days=rnd.randint(0, 120), hours=rnd.randint(1, 10))
+        data['startDateTime'] = start_date.strftime(DATE_FORMAT)
+        data['endDateTime'] = end_date.strftime(DATE_FORMAT)
+    return data
+
+
+def _get_profile(rnd, type_):
+    profiles = [p for p in PROFILES if ('manifestation' in p.name) == (type_ == 'm')]
+    value = rnd.uniform(0, sum(p.weight for p in profiles))
+    for profile in profiles:
+        value -= profile.weight
+        if value <= 0:
+            return profile
+    return profiles[-1]
+
+
+def _randint(rnd, value_range):
+    return rnd.randint(*value_range)
+
+
+def _create_periods(rnd, start_date, count):
+    periods = []
+    for _ in xrange(count):
+        end_date = start_date + timedelta(hours=rnd.randint(1, 48))
+        periods.append({
+            'startDateTime': start_date.strftime(DATE_FORMAT),
+            'endDateTime': end_date.strftime(DATE_FORMAT),
+        })
+        start_date = end_date + timedelta(days=rnd.randint(0, 7), hours=rnd.randint(0, 12))
+    # The api doesn't return the periods in order
+    rnd.shuffle(periods)
+    return periods
+
+
+def _create_location_geometry(rnd, lat, lon, profile):
+    polygons = [[_create_ring(rnd, lat + rnd.uniform(-0.005, 0.005), lon + rnd.uniform(-0.005, 0.005),
+                              _randint(rnd, profile.vertices))]
+                for _ in xrange(_randint(rnd, profile.polygons))]
+    if len(polygons) == 1:
+        return {'type': 'Polygon', 'coordinates': polygons[0]}
+    if rnd.random() < 0.2:
+        return {'type': 'GeometryCollection', 'geometries': [{'type': 'Polygon', 'coordinates': polygon}
+                                                             for polygon in polygons]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
+
+
+def _create_ring(rnd, lat, lon, vertex_count):
+    # Irregular, closed ring around lat, lon. Coordinates have as many decimals as the api sometimes returns.
+    radius = rnd.uniform(0.0002, 0.003)
+    ring = []
+    for i in xrange(vertex_count):
+        angle = 2 * math.pi * i / vertex_count
+        r = radius * rnd.uniform(0.8, 1.2)
+        ring.append([lon + r * math.cos(angle) * 1.6, lat + r * math.sin(angle)])
+    ring.append(list(ring[0]))
+    return ring
+
+
+def _create_line(rnd, lat, lon, vertex_count):
+    line = []
+    for _ in xrange(vertex_count):
+        line.append([lon, lat])
+        lat += rnd.uniform(-0.0003, 0.0003)
+        lon += rnd.uniform(-0.0003, 0.0003)
+    return line
+
+
+def _create_diversion(rnd, lat, lon, profile):
+    vertex_count = _randint(rnd, profile.diversion_vertices)
+    if rnd.random() < 0.5:
+        geometry = {'type': 'LineString', 'coordinates': _create_line(rnd, lat, lon, vertex_count)}
+    else:
+        geometry = {'type': 'MultiLineString',
+                    'coordinates': [_create_line(rnd, lat, lon, max(2, vertex_count / 3)) for _ in xrange(3)]}
+    return {
+        'geometry': geometry,
+        'diversionTypes': rnd.sample(['Auto', 'Fiets', 'Voetganger', 'Vrachtwagen', 'Bus'], rnd.randint(0, 3)),
+        'streets': rnd.sample(STREETS, rnd.randint(0, 5)),
+    }
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import json
+import os
+import re
+
+# Must be set before the plugin is imported. Indexing uses the in-process backend instead of elasticsearch.
+os.environ.setdefault('GIPOD_SEARCH_BACKEND', 'memory')
+
+from google.appengine.api import apiproxy_stub
+from google.appengine.ext import ndb, testbed
+
+from benchmarks.payloads import create_payload
+
+GIPOD_DETAIL_URL = re.compile(r'/(workassignment|manifestation)/(\d+)$')
+
+
+class GipodUrlFetchStub(apiproxy_stub.APIProxyStub):
+    # Stand-in for urlfetch that answers the requests for item details with synthetic payloads, so nothing is fetched
+    # over the network. Every other request gets a 404.
+
+    def __init__(self, seed=0):
+        super(GipodUrlFetchStub, self).__init__('urlfetch')
+        self.seed = seed
+        self.request_count = 0
+
+    def _Dynamic_Fetch(self, request, response):
+        self.request_count += 1
+        response.set_finalurl(request.url())
+        response.set_contentwastruncated(False)
+        match = GIPOD_DETAIL_URL.search(request.url())
+        if not match:
+            response.set_statuscode(404)
+            response.set_content('')
+            return
+        type_ = 'w' if match.group(1) == 'workassignment' else 'm'
+        response.set_statuscode(200)
+        response.set_content(json.dumps(create_payload(type_, long(match.group(2)), self.seed)))
+
+
+def activate(seed=0):
+    # type: (int) -> testbed.Testbed
+    # Replaces the datastore, memcache and urlfetch services with in-memory stand-ins
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed._register_stub(testbed.URLFETCH_SERVICE_NAME, GipodUrlFetchStub(seed))
+    # Entities are read from the datastore stub every time, like they would be in a new request
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().set_memcache_policy(False)
+    return bed
@@ -16,38 +16,86 @@
 # @@license_version:1.5@@
 from __future__ import unicode_literals
 
+import hashlib
 import json
 import logging
+import struct
 import urllib
 from datetime import datetime
 
-from dateutil.parser import parse as parse_datetime
-from google.appengine.api import urlfetch
-from typing import Union, List, Iterable
+from google.appengine.api import urlfetch, apiproxy_stub_map
+from google.appengine.ext import ndb
+from typing import Union, List, Iterable, Tuple, Dict
 
-from plugins.gipod.models import Manifestation, WorkAssignment, MapUser
+from plugins.gipod.bizz.search import get_model_key_from_search_result_id
+from plugins.gipod.models import Manifestation, WorkAssignment, MapUser, MapItem, BaseModel
 from plugins.gipod.plugin_consts import GIPOD_API_URL
-from plugins.gipod.to import MapItemTO, GeoPointTO, MapIconTO, MapItemDetailsTO, CoordsListTO, \
+from plugins.gipod.to import MapItemTO, MapClusterTO, GeoPointTO, MapIconTO, MapItemDetailsTO, CoordsListTO, \
     PolygonGeometryTO, MultiPolygonGeometryTO, PolygonTO, LineStringGeometryTO, MultiLineStringGeometryTO, \
-    TextSectionTO, GeometrySectionTO
-from plugins.gipod.utils import get_app_id_from_user_id
-
+    TextSectionTO, GeometrySectionTO, GeometryFormat, EncodedLineStringGeometryTO, EncodedMultiLineStringGeometryTO, \
+    EncodedPolygonGeometryTO, EncodedMultiPolygonGeometryTO, EncodedPolygonTO
+from plugins.gipod.utils import get_app_id_from_user_id, get_datetime_from_epoch, parse_datetime
+from plugins.gipod.utils.geometry import simplify_geometry, count_vertices, encode_polyline
+from plugins.gipod.utils.packed_geometry import PackedGeometry, can_pack_geometry, pack_geometries, \
+    unpack_geometries
+
+IMPORTANT_COLOR = '#f10812'
 NOT_IMPORTANT_COLOR = '#eeb309'
+MANIFESTATION_COLOR = '#263583'
 
+DELETED_ITEM_HASH = 'deleted'
 
-def do_request_without_processing(relative_url, params=None):
-    # type: (str, dict) -> urlfetch._URLFetchResult
+# Simplification tolerances in degrees, about the size of a pixel at zoom level 16, 14, 12 and 10
+GEOMETRY_TOLERANCES = (0.00002, 0.0001, 0.0004, 0.0015)
+
+
+def _get_url(relative_url, params=None):
+    # type: (str, dict) -> str
     url = '%s%s' % (GIPOD_API_URL, relative_url)
     if params:
         query_params = urllib.urlencode(params)
         if query_params:
             url = '%s?%s' % (url, query_params)
+    return url
+
+
+def do_request_without_processing(relative_url, params=None):
+    # type: (str, dict) -> urlfetch._URLFetchResult
+    url = _get_url(relative_url, params)
 
     logging.info('do_request: %s', url)
 
     return urlfetch.fetch(url, deadline=30, follow_redirects=False)
 
 
+def do_requests_async(relative_urls, concurrency=10, deadline=30):
+    # type: (Iterable[str], int, int) -> Iterable[Tuple[str, Union[urlfetch._URLFetchResult, Exception]]]
+    # Keeps up to `concurrency` requests in flight and yields every result (or error) as soon as it completes
+    relative_urls = iter(relative_urls)
+    pending = {}
+
+    def start_next():
+        for relative_url in relative_urls:
+            url = _get_url(relative_url)
+            logging.debug('do_request_async: %s', url)
+            rpc = urlfetch.create_rpc(deadline=deadline)
+            urlfetch.make_fetch_call(rpc, url, follow_redirects=False)
+            pending[rpc] = relative_url
+            return
+
+    for _ in xrange(concurrency):
+        start_next()
+    while pending:
+        rpc = apiproxy_stub_map.UserRPC.wait_any(pending.keys())
+        relative_url = pending.pop(rpc)
+        try:
+            result = rpc.get_result()
+        except Exception as e:
+            result = e
+        start_next()
+        yield relative_url, result
+
+
 def do_request(relative_url, params=None):
     result = do_request_without_processing(relative_url, params)
     if result.status_code != 200:
@@ -86,6 +134,75 @@ def validate_and_clean_data(type_, uid, data):
             _clean_geometry(diversion['geometry'])
 
 
+def create_geometry_levels(data):
+    # type: (dict) -> List[dict]
+    location_geometry = data['location']['geometry']
+    diversion_geometries = [diversion['geometry'] for diversion in data.get('diversions') or []]
+    vertex_count = _count_item_vertices(location_geometry, diversion_geometries)
+    levels = []
+    for tolerance in GEOMETRY_TOLERANCES:
+        level = {
+            'tolerance': tolerance,
+            'location': simplify_geometry(location_geometry, tolerance),
+            'diversions': [simplify_geometry(g, tolerance) for g in diversion_geometries],
+        }
+        level_vertex_count = _count_item_vertices(level['location'], level['diversions'])
+        # No need to store levels that aren't smaller than the previous one
+        if level_vertex_count < vertex_count:
+            levels.append(level)
+            vertex_count = level_vertex_count
+    return levels
+
+
+def _count_item_vertices(location_geometry, diversion_geometries):
+    return count_vertices(location_geometry) + sum(count_vertices(g) for g in diversion_geometries)
+
+
+def get_geometry_tolerance(tolerance):
+    # type: (float) -> float
+    # The tolerance of the geometry level used for this tolerance (see get_item_geometries), None for the full geometry
+    tolerances = [t for t in GEOMETRY_TOLERANCES if tolerance and t <= tolerance]
+    return max(tolerances) if tolerances else None
+
+
+def get_item_geometries(model, tolerance=None):
+    # type: (Union[WorkAssignment, Manifestation], float) -> Tuple[dict, List[dict]]
+    if tolerance and model.geometry_levels:
+        # Use the coarsest level that is still within the requested tolerance
+        for level in reversed(model.geometry_levels):
+            if level['tolerance'] <= tolerance:
+                return level['location'], level['diversions']
+    if model.packed_geometries:
+        geometries = unpack_geometries(model.packed_geometries)
+        return geometries[0], geometries[1:]
+    diversions = model.data.get('diversions') or []
+    return model.data['location']['geometry'], [diversion['geometry'] for diversion in diversions]
+
+
+def pack_item_geometries(model):
+    # type: (Union[WorkAssignment, Manifestation]) -> None
+    # Moves the location and diversion geometries from data to packed_geometries, which is a lot smaller and faster to
+    # load. Must be called every time the data of the model changes. Items with unknown geometries are kept in data.
+    diversions = model.data.get('diversions') or []
+    geometries = [model.data['location']['geometry']] + [diversion['geometry'] for diversion in diversions]
+    model.packed_geometries = None
+    if not all(can_pack_geometry(geometry) for geometry in geometries):
+        return
+    try:
+        model.packed_geometries = pack_geometries(geometries)
+    except (TypeError, ValueError, struct.error) as e:
+        logging.warn('Could not pack the geometries of %s: %s', model.uid, e)
+        return
+    model.data['location']['geometry'] = None
+    for diversion in diversions:
+        diversion['geometry'] = None
+
+
+def get_data_hash(data):
+    # type: (dict) -> unicode
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':'))).hexdigest().decode('ascii')
+
+
 def _clean_geometry(geometry):
     if geometry['type'] == 'GeometryCollection':
         for item in geometry['geometries']:
@@ -96,6 +213,14 @@ def _clean_geometry(geometry):
 
 # Removes unnecessary decimals (some were up to 16 decimals long!) from the coordinates (https://xkcd.com/2170)
 def _clean_coordinates(coordinates_list):
+    if coordinates_list and isinstance(coordinates_list[0], list) and coordinates_list[0] \
+            and isinstance(coordinates_list[0][0], float):
+        # List of points, rounded in one go instead of checking every value separately
+        try:
+            coordinates_list[:] = [[round(value, 6) for value in point] for point in coordinates_list]
+            return coordinates_list
+        except TypeError:
+            pass
     for i, item in enumerate(coordinates_list):
         if isinstance(item, list):
             coordinates_list[i] = _clean_coordinates(item)
@@ -109,7 +234,7 @@ def _clean_coordinates(coordinates_list):
 
 def get_workassignment_icon(important=False):
     if important:
-        return 'important', '#f10812'
+        return 'important', IMPORTANT_COLOR
     else:
         return 'non_important', NOT_IMPORTANT_COLOR
 
@@ -131,7 +256,7 @@ def get_manifestation_icon(event_type=None):
         'Wielerwedstrijd - open criterium': 'cycling_line'
     }
 
-    icon_color = '#263583'
+    icon_color = MANIFESTATION_COLOR
     if event_type:
         event_type = event_type.strip()
         if event_type in m:
@@ -141,11 +266,105 @@ def get_manifestation_icon(event_type=None):
     return 'other', icon_color
 
 
-def convert_to_item_tos(models):
-    # type: (Iterable[Union[WorkAssignment, Manifestation]]) -> List[MapItemTO]
+def get_icon_color(icon_id):
+    # type: (unicode) -> unicode
+    if icon_id == 'important':
+        return IMPORTANT_COLOR
+    elif icon_id == 'non_important':
+        return NOT_IMPORTANT_COLOR
+    return MANIFESTATION_COLOR
+
+
+def convert_cluster_buckets_to_tos(buckets):
+    # type: (List[dict]) -> List[MapClusterTO]
+    clusters = []
+    for bucket in buckets:
+        centroid = bucket['centroid']['location']
+        icon = None
+        if bucket['icons']['buckets']:
+            icon_id = bucket['icons']['buckets'][0]['key']
+            icon = MapIconTO(id=icon_id, color=get_icon_color(icon_id))
+        clusters.append(MapClusterTO(coords=GeoPointTO(lat=centroid['lat'], lon=centroid['lon']),
+                                     count=bucket['doc_count'],
+                                     icon=icon))
+    return clusters
+
+
+def get_item_icon(model):
+    # type: (Union[WorkAssignment, Manifestation]) -> Tuple[unicode, unicode]
+    if isinstance(model, Manifestation):
+        return get_manifestation_icon(model.data['eventType'])
+    elif isinstance(model, WorkAssignment):
+        hindrance = model.data.get('hindrance') or {}
+        return get_workassignment_icon(hindrance.get('important', False))
+    raise Exception('Unknown item type %s' % model)
+
+
+def get_item_periods(model):
+    # type: (Union[WorkAssignment, Manifestation]) -> List[Tuple[datetime, datetime]]
+    # Sorted by start date
+    if model.start_dates:
+        return model.periods
+    # Item that was saved before the periods were stored on the model
+    return parse_item_periods(model.TYPE, model.data)
+
+
+def set_item_periods(model):
+    # type: (Union[WorkAssignment, Manifestation]) -> None
+    # Must be called every time the data of the model changes
+    sorted_periods = parse_item_periods(model.TYPE, model.data)
+    model.start_dates = [start_date for start_date, _ in sorted_periods]
+    model.end_dates = [end_date for _, end_date in sorted_periods]
+
+
+def parse_item_periods(type_, data):
+    # type: (str, dict) -> List[Tuple[datetime, datetime]]
+    if type_ == Manifestation.TYPE:
+        periods = [(parse_datetime(p['startDateTime']), parse_datetime(p['endDateTime']))
+                   for p in data.get('periods', [])]
+    elif type_ == WorkAssignment.TYPE:
+        periods = [(parse_datetime(data['startDateTime']), parse_datetime(data['endDateTime']))]
+    else:
+        raise Exception('Unknown item type %s' % type_)
+    return sorted(periods, key=lambda a: a[0])
+
+
+def create_map_item(model):
+    # type: (Union[WorkAssignment, Manifestation]) -> MapItem
+    icon_id, icon_color = get_item_icon(model)
+    sorted_periods = get_item_periods(model)
+    coordinates = model.data['location']['coordinate']['coordinates']
+    return MapItem(key=MapItem.create_key(model.uid),
+                   lat=coordinates[1],
+                   lon=coordinates[0],
+                   icon_id=icon_id,
+                   icon_color=icon_color,
+                   title=model.data['description'],
+                   data_hash=model.data_hash,
+                   modified=model.modified,
+                   start_dates=[start_date for start_date, _ in sorted_periods],
+                   end_dates=[end_date for _, end_date in sorted_periods])
+
+
+def get_map_items(keys):
+    # type: (Iterable[ndb.Key]) -> List[MapItem]
+    keys = list(keys)
+    map_items = ndb.get_multi([MapItem.create_key(key.id()) for key in keys])
+    missing_keys = [key for key, map_item in zip(keys, map_items) if not map_item]
+    if missing_keys:
+        # Only happens for items that have not been re-indexed since MapItem was introduced
+        logging.info('Creating %d missing map items', len(missing_keys))
+        created = {m.uid: create_map_item(m) for m in ndb.get_multi(missing_keys) if m}
+        ndb.put_multi(created.values())
+        map_items = [map_item or created.get(key.id()) for key, map_item in zip(keys, map_items)]
+    return [map_item for map_item in map_items if map_item]
+
+
+def convert_to_item_tos(map_items):
+    # type: (Iterable[MapItem]) -> List[MapItemTO]
     items = []
     now_ = datetime.utcnow()
-    for m in models:
+    for m in map_items:
         try:
             items.append(convert_to_item_to(m, now_))
         except:
@@ -155,34 +374,67 @@ def convert_to_item_tos(models):
     return items
 
 
-def convert_to_item_to(model, now_):
-    if isinstance(model, Manifestation):
-        description = None
-        icon_id, icon_color = get_manifestation_icon(model.data['eventType'])
-        # Sort by start date
-        sorted_periods = sorted(((parse_datetime(p['startDateTime']), parse_datetime(p['endDateTime']))
-                                 for p in model.data.get('periods', [])), key=lambda a: a[0])
-        for start_date, end_date in sorted_periods:
-            # Skip dates in the past
-            if end_date < now_:
-                continue
-            description = period_to_string(now_, start_date, end_date, False)
-            break
-    elif isinstance(model, WorkAssignment):
-        hindrance = model.data.get('hindrance') or {}
-        icon_id, icon_color = get_workassignment_icon(hindrance.get('important', False))
-        start_date = parse_datetime(model.data['startDateTime'])
-        end_date = parse_datetime(model.data['endDateTime'])
+def convert_to_item_to(map_item, now_):
+    # type: (MapItem, datetime) -> MapItemTO
+    return _create_item_to(map_item.uid, map_item.lat, map_item.lon, map_item.icon_id, map_item.icon_color,
+                           map_item.title, map_item.periods, now_)
+
+
+def convert_search_hits_to_item_tos(hits):
+    # type: (List[Tuple[unicode, dict]]) -> Iterable[MapItemTO]
+    # Documents that were indexed before the map item fields were added to them need their MapItem
+    incomplete_keys = [get_model_key_from_search_result_id(uid) for uid, source in hits if 'title' not in source]
+    map_items = {}
+    if incomplete_keys:
+        map_items = {m.uid: m for m in get_map_items(key for key in incomplete_keys if key)}
+    # Items are converted lazily, so they can be written to the response one by one
+    return _convert_search_hits_to_item_tos(hits, map_items, datetime.utcnow())
+
+
+def _convert_search_hits_to_item_tos(hits, map_items, now_):
+    # type: (List[Tuple[unicode, dict]], Dict[unicode, MapItem], datetime) -> Iterable[MapItemTO]
+    seen_uids = set()
+    for uid, source in hits:
+        try:
+            if 'title' in source:
+                item = convert_search_hit_to_item_to(uid, source, now_)
+            else:
+                key = get_model_key_from_search_result_id(uid)
+                map_item = key and map_items.get(key.id())
+                if not map_item:
+                    continue
+                item = convert_to_item_to(map_item, now_)
+        except:
+            logging.debug('uid: %s', uid)
+            raise
+        if item.id not in seen_uids:
+            seen_uids.add(item.id)
+            yield item
+
+
+def convert_search_hit_to_item_to(uid, source, now_):
+    # type: (unicode, dict, datetime) -> MapItemTO
+    periods = ((get_datetime_from_epoch(start_date), get_datetime_from_epoch(end_date))
+               for start_date, end_date in source['periods'])
+    return _create_item_to(uid, source['location']['lat'], source['location']['lon'], source['icon']['id'],
+                           source['icon']['color'], source['title'], periods, now_)
+
+
+def _create_item_to(uid, lat, lon, icon_id, icon_color, title, sorted_periods, now_):
+    description = None
+    for start_date, end_date in sorted_periods:
+        # Skip dates in the past
+        if end_date < now_:
+            continue
         description = period_to_string(now_, start_date, end_date, False)
-    else:
-        raise Exception('Unknown item type %s' % model)
+        break
 
-    return MapItemTO(id=model.uid,
-                     coords=GeoPointTO(lat=model.data['location']['coordinate']['coordinates'][1],
-                                       lon=model.data['location']['coordinate']['coordinates'][0]),
+    return MapItemTO(id=uid,
+                     coords=GeoPointTO(lat=lat,
+                                       lon=lon),
                      icon=MapIconTO(id=icon_id,
                                     color=icon_color),
-                     title=model.data['description'],
+                     title=title,
                      description=description)
 
 
@@ -210,20 +462,56 @@ def get_date_format(now, date, include_time):
     return '%d/%m/%Y'
 
 
-def convert_to_item_details_tos(uids, models):
-    items = []
+def get_item_details_version(data_hash, current_date, tolerance, geometry_format):
+    # type: (unicode, datetime, float, str) -> unicode
+    # Changes whenever the details of an item change: when its data changes, every day (periods that ended are hidden)
+    # and for every geometry level and geometry format. Unknown when the hash of the data isn't known.
+    if not data_hash:
+        return None
+    version = '%s|%s|%s|%s' % (data_hash, current_date.date().isoformat(), get_geometry_tolerance(tolerance),
+                               geometry_format)
+    return hashlib.sha1(version.encode('utf-8')).hexdigest()[:16].decode('ascii')
+
+
+def get_item_details_versions(keys, current_date, tolerance, geometry_format):
+    # type: (List[ndb.Key], datetime, float, str) -> Dict[unicode, unicode]
+    # Only loads the MapItems, not the items themselves
+    map_items = {map_item.uid: map_item for map_item in get_map_items(keys)}
+    versions = {}
+    for key in keys:
+        map_item = map_items.get(key.id())
+        # Items without MapItem don't exist (anymore), their details don't change either
+        data_hash = map_item.data_hash if map_item else DELETED_ITEM_HASH
+        versions[key.id()] = get_item_details_version(data_hash, current_date, tolerance, geometry_format)
+    return versions
+
+
+def get_details_etag(versions, unchanged_ids):
+    # type: (Dict[unicode, unicode], List[unicode]) -> str
+    # None when the version of one of the items is unknown. The response doesn't contain the items that the client
+    # already has, so those are part of the etag too.
+    if None in versions.itervalues():
+        return None
+    content = [sorted(versions.iteritems()), sorted(unchanged_ids)]
+    return hashlib.sha1(json.dumps(content, separators=(',', ':'))).hexdigest().decode('ascii')
+
+
+def convert_to_item_details_tos(uids, models, tolerance=None, geometry_format=GeometryFormat.COORDINATES):
+    # type: (List[unicode], List[BaseModel], float, str) -> Iterable[MapItemDetailsTO]
     current_date = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     for uid, m in zip(uids, models):
         try:
-            items.append(convert_to_item_details_to(uid, m, current_date))
+            yield convert_to_item_details_to(uid, m, current_date, tolerance, geometry_format)
         except:
             logging.debug('uid: %s', uid)
             raise
 
-    return items
-
 
-def get_geometry_to(data, color):
+def get_geometry_to(data, color, geometry_format=GeometryFormat.COORDINATES):
+    if isinstance(data, PackedGeometry):
+        return _get_packed_geometry_to(data, color, geometry_format)
+    if geometry_format == GeometryFormat.ENCODED_POLYLINE:
+        return _get_encoded_geometry_to(data, color)
     if data['type'] == 'LineString':
         return LineStringGeometryTO(
             color=color,
@@ -256,65 +544,119 @@ def get_geometry_to(data, color):
         return None
 
 
-def get_geometry_tos(uid, data, color):
-    if data['type'] in ('LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'):
-        return [get_geometry_to(data, color)]
-    elif data['type'] == 'GeometryCollection':
+def _get_encoded_geometry_to(data, color):
+    if data['type'] == 'LineString':
+        return EncodedLineStringGeometryTO(color=color, line=encode_polyline(data['coordinates']))
+    elif data['type'] == 'MultiLineString':
+        return EncodedMultiLineStringGeometryTO(
+            color=color,
+            lines=[encode_polyline(list_of_coords) for list_of_coords in data['coordinates'] if list_of_coords]
+        )
+    elif data['type'] == 'Polygon':
+        return EncodedPolygonGeometryTO(
+            color=color,
+            rings=[encode_polyline(list_of_coords) for list_of_coords in data['coordinates'] if list_of_coords]
+        )
+    elif data['type'] == 'MultiPolygon':
+        return EncodedMultiPolygonGeometryTO(
+            color=color,
+            polygons=[EncodedPolygonTO(rings=[encode_polyline(list_of_coords)
+                                              for list_of_coords in nested_coordinates if list_of_coords])
+                      for nested_coordinates in data['coordinates'] if nested_coordinates]
+        )
+    else:
+        return None
+
+
+def _get_packed_geometry_to(geometry, color, geometry_format):
+    # type: (PackedGeometry, unicode, str) -> object
+    # Same as get_geometry_to, but reads the coordinates straight from the packed arrays
+    encoded = geometry_format == GeometryFormat.ENCODED_POLYLINE
+
+    def get_rings(part):
+        if encoded:
+            return [encode_polyline(ring) for ring in geometry.get_rings(part) if ring]
+        return [CoordsListTO(coords=[GeoPointTO(lat=lat, lon=lon) for lon, lat in ring])
+                for ring in geometry.get_rings(part) if ring]
+
+    if geometry.type == 'LineString':
+        lines = get_rings(0)
+        if encoded:
+            return EncodedLineStringGeometryTO(color=color, line=lines[0] if lines else '')
+        return LineStringGeometryTO(color=color, line=lines[0] if lines else CoordsListTO(coords=[]))
+    elif geometry.type == 'MultiLineString':
+        if encoded:
+            return EncodedMultiLineStringGeometryTO(color=color, lines=get_rings(0))
+        return MultiLineStringGeometryTO(color=color, lines=get_rings(0))
+    elif geometry.type == 'Polygon':
+        if encoded:
+            return EncodedPolygonGeometryTO(color=color, rings=get_rings(0))
+        return PolygonGeometryTO(color=color, rings=get_rings(0))
+    elif geometry.type == 'MultiPolygon':
+        polygon_class = EncodedPolygonTO if encoded else PolygonTO
+        polygons = [polygon_class(rings=rings) for rings in (get_rings(part) for part in xrange(geometry.part_count))
+                    if rings]
+        if encoded:
+            return EncodedMultiPolygonGeometryTO(color=color, polygons=polygons)
+        return MultiPolygonGeometryTO(color=color, polygons=polygons)
+    return None
+
+
+def get_geometry_tos(uid, data, color, geometry_format=GeometryFormat.COORDINATES):
+    if isinstance(data, PackedGeometry):
+        geometry_type = data.type
+        geometries = data.geometries
+    else:
+        geometry_type = data['type']
+        geometries = data.get('geometries')
+    if geometry_type in ('LineString', 'MultiLineString', 'Polygon', 'MultiPolygon'):
+        return [get_geometry_to(data, color, geometry_format)]
+    elif geometry_type == 'GeometryCollection':
         geo_list = []
-        for g in data['geometries']:
-            to = get_geometry_to(g, color)
+        for g in geometries:
+            to = get_geometry_to(g, color, geometry_format)
             if to:
                 geo_list.append(to)
             else:
-                logging.error('Unknown geometry collection  type: "%s" for %s', g['type'], uid)
+                logging.error('Unknown geometry collection  type: "%s" for %s',
+                              g.type if isinstance(g, PackedGeometry) else g['type'], uid)
         return geo_list
 
-    logging.error('Unknown geometry type: "%s" for %s', data['type'], uid)
+    logging.error('Unknown geometry type: "%s" for %s', geometry_type, uid)
     return []
 
 
-def convert_to_item_details_to(uid, model, current_date):
-    # type: (str, Union[WorkAssignment, Manifestation], datetime) -> MapItemDetailsTO
+def convert_to_item_details_to(uid, model, current_date, tolerance=None, geometry_format=GeometryFormat.COORDINATES):
+    # type: (str, Union[WorkAssignment, Manifestation], datetime, float, str) -> MapItemDetailsTO
     to = MapItemDetailsTO(id=uid,
                           geometry=[],
                           sections=[])
-    hindrance = model.data.get('hindrance') or {}
-    if isinstance(model, WorkAssignment):
-        _, icon_color = get_workassignment_icon(hindrance.get('important', False))
-    elif isinstance(model, Manifestation):
-        _, icon_color = get_manifestation_icon(model.data['eventType'])
-    elif model is None:
+    if model is None:
         # Chances of this happening *should* be very low
         # This should only happen when user has the map open for a long time,
         # and he clicks on an item that has been deleted in the mean time
         to.sections = [TextSectionTO(title='Verwijderd',
                                      description='Dit item bestaat niet meer')]
         return to
+    hindrance = model.data.get('hindrance') or {}
+    if isinstance(model, WorkAssignment):
+        _, icon_color = get_workassignment_icon(hindrance.get('important', False))
+    elif isinstance(model, Manifestation):
+        _, icon_color = get_manifestation_icon(model.data['eventType'])
     else:
         raise Exception('Unknown type: %s', model)
 
-    to.geometry = get_geometry_tos(uid, model.data['location']['geometry'], icon_color)
+    location_geometry, diversion_geometries = get_item_geometries(model, tolerance)
+    to.geometry = get_geometry_tos(uid, location_geometry, icon_color, geometry_format)
 
-    dates = []
-    if isinstance(model, WorkAssignment):
-        start_date = datetime.strptime(model.data['startDateTime'], "%Y-%m-%dT%H:%M:%S")
-        end_date = datetime.strptime(model.data['endDateTime'], "%Y-%m-%dT%H:%M:%S")
-        dates.append({'start': start_date, 'end': end_date})
-    elif isinstance(model, Manifestation):
-        for i, p in enumerate(model.data['periods']):
-            end_date = datetime.strptime(p['endDateTime'], "%Y-%m-%dT%H:%M:%S")
-            if end_date < current_date:
-                continue
-            start_date = datetime.strptime(p['startDateTime'], "%Y-%m-%dT%H:%M:%S")
-
-            dates.append({'start': start_date, 'end': end_date})
-            if len(dates) > 2:
-                break
-    if dates:
-        sorted_dates = sorted(dates, key=lambda d: d['start'])
+    periods = get_item_periods(model)
+    if isinstance(model, Manifestation):
+        # Only the first 3 periods that didn't end yet
+        periods = [(start_date, end_date) for start_date, end_date in periods if end_date >= current_date][:3]
+    if periods:
         periods_message = []
-        for d in sorted_dates:
-            periods_message.append(period_to_string(current_date, d['start'], d['end'], True))
+        for start_date, end_date in periods:
+            periods_message.append(period_to_string(current_date, start_date, end_date, True))
 
         contact_details = model.data.get('contactDetails') or {}
         if contact_details.get('organisation'):
@@ -350,7 +692,8 @@ def convert_to_item_details_to(uid, model, current_date):
         title = 'Omleiding %d' % (i + 1) if len(diversions) > 1 else 'Omleiding'
         to.sections.append(GeometrySectionTO(title=title,
                                              description='\n'.join(lines),
-                                             geometry=get_geometry_tos(model.uid, diversion['geometry'], '#2dc219')))
+                                             geometry=get_geometry_tos(model.uid, diversion_geometries[i],
+                                                                       '#2dc219', geometry_format)))
 
     return to
 
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from __future__ import unicode_literals
+
+from google.appengine.api import memcache
+
+from plugins.gipod.models import Consumer
+from plugins.gipod.plugin_consts import NAMESPACE
+from plugins.gipod.utils.cache import LRUCache
+
+# Max amount of seconds before a revoked consumer is refused, per cache level
+CONSUMER_CACHE_TTL = 60
+
+# Caches both valid and unknown consumer keys, so invalid keys can't be used to hammer the datastore
+_consumer_cache = LRUCache(max_size=1000, ttl=CONSUMER_CACHE_TTL)
+
+
+def _get_memcache_key(consumer_key):
+    return 'consumer-%s' % consumer_key
+
+
+def is_valid_consumer(consumer_key):
+    # type: (unicode) -> bool
+    is_valid = _consumer_cache.get(consumer_key)
+    if is_valid is None:
+        memcache_key = _get_memcache_key(consumer_key)
+        is_valid = memcache.get(memcache_key, namespace=NAMESPACE)
+        if is_valid is None:
+            is_valid = Consumer.create_key(consumer_key).get() is not None
+            memcache.set(memcache_key, is_valid, time=CONSUMER_CACHE_TTL, namespace=NAMESPACE)
+        _consumer_cache.set(consumer_key, is_valid)
+    return is_valid
+
+
+def invalidate_consumer(consumer_key):
+    # type: (unicode) -> None
+    _consumer_cache.delete(consumer_key)
+    memcache.delete(_get_memcache_key(consumer_key), namespace=NAMESPACE)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from __future__ import unicode_literals
+
+import base64
+import os
+from datetime import datetime
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from typing import Set, List, Tuple
+
+from plugins.gipod.bizz.search_cache import perform_search
+from plugins.gipod.models import MapItem
+from plugins.gipod.plugin_consts import NAMESPACE
+from plugins.gipod.utils import get_datetime_from_epoch, get_epoch_from_datetime
+from plugins.gipod.utils.timing import get_request_timer
+
+# A sync token refers to the ids a client received and when it received them, so the next delta only contains what
+# changed since then. Clients with an unknown or expired token can send the ids they know instead.
+DELTA_TOKEN_TTL = 7 * 86400  # seconds
+DELTA_PAGE_SIZE = 500
+# Like the item list, only the first results of a query are synced. truncated is set when there are more.
+MAX_DELTA_ITEMS = 1000
+# Items are marked as modified right before they are saved, and the search index is only refreshed after that.
+# Changes made shortly before the previous delta are reported again, in case that delta still saw the old data.
+MODIFIED_MARGIN = 60  # seconds
+
+
+def _get_memcache_key(token):
+    return 'delta-%s' % token
+
+
+def get_items_delta(lat, lon, distance, start, end, filter_type, bbox, token=None, known_ids=None, since=None):
+    # type: (float, float, int, str, str, str, dict, unicode, List[unicode], long) -> dict
+    # Returns the ids that were added to the results of this query, removed from them and the ones that changed,
+    # compared to the ids the client knows. reset is True when those ids aren't known (e.g. the token expired), the
+    # client should then only keep the added ids.
+    snapshot = memcache.get(_get_memcache_key(token), namespace=NAMESPACE) if token else None
+    if snapshot:
+        known_ids, since = snapshot['ids'], snapshot['time']
+    reset = known_ids is None
+    known_ids = set(known_ids or [])
+    # Taken before searching, items that change while searching are included in the next delta again
+    now_ = get_epoch_from_datetime(datetime.utcnow())
+    timer = get_request_timer()
+    with timer.phase('search'):
+        current_ids, truncated = _get_current_ids(lat, lon, distance, start, end, filter_type, bbox)
+    with timer.phase('modified'):
+        changed_ids = _get_changed_ids(known_ids & current_ids, since) if since and not reset else []
+
+    new_token = base64.urlsafe_b64encode(os.urandom(12)).decode('ascii')
+    memcache.set(_get_memcache_key(new_token), {'ids': sorted(current_ids), 'time': now_},
+                 time=DELTA_TOKEN_TTL, namespace=NAMESPACE)
+    return {
+        'token': new_token,
+        'time': now_,
+        'reset': reset,
+        'truncated': truncated,
+        'added': sorted(current_ids - known_ids),
+        'removed': sorted(known_ids - current_ids),
+        'changed': sorted(changed_ids),
+    }
+
+
+def _get_current_ids(lat, lon, distance, start, end, filter_type, bbox):
+    # type: (float, float, int, str, str, str, dict) -> Tuple[Set[unicode], bool]
+    # Same order as the ids endpoint, so the same items are dropped when there are more than MAX_DELTA_ITEMS
+    ids = set()
+    cursor = None
+    while True:
+        keys, cursor = perform_search(lat, lon, distance, start, end, cursor, DELTA_PAGE_SIZE, filter_type, bbox)
+        ids.update(key.id() for key in keys)
+        if not cursor:
+            return ids, False
+        if len(ids) >= MAX_DELTA_ITEMS:
+            return ids, True
+
+
+def _get_changed_ids(uids, since):
+    # type: (Set[unicode], long) -> List[unicode]
+    # Items of which the data changed after `since` (epoch)
+    since_date = get_datetime_from_epoch(since - MODIFIED_MARGIN)
+    map_items = ndb.get_multi([MapItem.create_key(uid) for uid in uids])
+    return [m.uid for m in map_items if m and m.modified and m.modified > since_date]
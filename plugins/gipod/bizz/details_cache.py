@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from __future__ import unicode_literals
+
+import logging
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from typing import Dict, Tuple, Iterable
+
+from plugins.gipod.bizz import GEOMETRY_TOLERANCES
+from plugins.gipod.plugin_consts import NAMESPACE
+from plugins.gipod.to import GeometryFormat
+from plugins.gipod.utils.cache import LRUCache
+
+# Serialized item details, per uid and version (see get_item_details_version). The version changes when the data of the
+# item changes and every day, so cached details never have to be invalidated to stay correct.
+DETAILS_CACHE_TTL = 86400  # seconds
+# Versions per uid kept in memory: one for every geometry level (and the full geometry) in every geometry format.
+# The oldest version is dropped first, e.g. the one of the previous day.
+MAX_LOCAL_VERSIONS = (len(GEOMETRY_TOLERANCES) + 1) * len((GeometryFormat.COORDINATES, GeometryFormat.ENCODED_POLYLINE))
+# Details of large items can be hundreds of KB, so the memory used by the cache is limited too
+MAX_LOCAL_BYTES = 8 * 1024 * 1024
+_details_cache = LRUCache(max_size=1000, ttl=DETAILS_CACHE_TTL, max_bytes=MAX_LOCAL_BYTES,
+                          get_size=lambda versions: sum(len(serialized) for serialized in versions.itervalues()))
+
+
+def _get_memcache_key(uid, version):
+    return 'details-%s-%s' % (uid, version)
+
+
+def get_cached_item_details(versions):
+    # type: (Dict[unicode, unicode]) -> Dict[unicode, str]
+    # Returns the serialized details that are cached for these versions, per uid
+    result = {}
+    missing = {}
+    for uid, version in versions.iteritems():
+        serialized = (_details_cache.get(uid) or {}).get(version)
+        if serialized is None:
+            missing[_get_memcache_key(uid, version)] = (uid, version)
+        else:
+            result[uid] = serialized
+    if missing:
+        for memcache_key, serialized in memcache.get_multi(missing.keys(), namespace=NAMESPACE).iteritems():
+            uid, version = missing[memcache_key]
+            _set_local(uid, version, serialized)
+            result[uid] = serialized
+    return result
+
+
+def cache_item_details(rendered):
+    # type: (Dict[unicode, Tuple[unicode, str]]) -> None
+    # rendered contains the version and serialized details per uid
+    if not rendered:
+        return
+    mapping = {}
+    for uid, (version, serialized) in rendered.iteritems():
+        _set_local(uid, version, serialized)
+        # memcache raises an error for values that are too big instead of skipping them
+        if len(serialized) <= memcache.MAX_VALUE_SIZE:
+            mapping[_get_memcache_key(uid, version)] = serialized
+    if not mapping:
+        return
+    try:
+        memcache.set_multi(mapping, time=DETAILS_CACHE_TTL, namespace=NAMESPACE)
+    except ValueError as e:
+        # The response was already sent, failing to cache it shouldn't turn it into an error
+        logging.warning('Could not cache item details: %s', e)
+
+
+def invalidate_item_details(uids):
+    # type: (Iterable[unicode]) -> None
+    # Outdated versions are never read, this only frees the memory they use on this instance
+    for uid in uids:
+        _details_cache.delete(uid)
+
+
+def _set_local(uid, version, serialized):
+    # type: (unicode, unicode, str) -> None
+    versions = OrderedDict(_details_cache.get(uid) or {})
+    versions.pop(version, None)
+    while len(versions) >= MAX_LOCAL_VERSIONS:
+        versions.popitem(last=False)
+    versions[version] = serialized
+    _details_cache.set(uid, versions)
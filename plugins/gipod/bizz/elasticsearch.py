@@ -16,15 +16,17 @@
 # @@license_version:1.5@@
 
 import base64
-import itertools
 import json
 import logging
+import time
 
 from google.appengine.api import urlfetch
 from mcfw.consts import DEBUG
-from typing import Dict, Tuple, Iterable, List, Union
+from typing import Dict, Tuple, Iterable, List, Union, Callable
 
-from plugins.gipod.models import WorkAssignment, Manifestation, ElasticsearchSettings, ItemFilterType
+from plugins.gipod.bizz.search import SearchBackend, create_cursor, parse_cursor, get_cluster_precision, MAX_CLUSTERS
+from plugins.gipod.models import ElasticsearchSettings, ItemFilterType, ItemSort
+from plugins.gipod.utils.timing import get_request_timer
 
 
 def get_elasticsearch_config():
@@ -37,50 +39,106 @@ def get_elasticsearch_config():
     return settings
 
 
-def _request(config, path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204)):
-    # type: (ElasticsearchSettings, str, int, Union[Dict, str], Tuple[int]) -> Dict
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (config.auth_username, config.auth_password))
-    }
-    if payload:
-        if isinstance(payload, basestring):
-            headers['Content-Type'] = 'application/x-ndjson'
-        else:
-            headers['Content-Type'] = 'application/json'
-    data = json.dumps(payload) if isinstance(payload, dict) else payload
-    url = config.base_url + path
-    if DEBUG:
-        if data:
-            logging.debug('%s\n%s', url, data)
+class ElasticsearchClient(object):
+    # Settings are kept in memory so requests don't need a datastore get first
+    SETTINGS_TTL = 300  # seconds
+
+    def __init__(self):
+        self._config = None  # type: ElasticsearchSettings
+        self._headers = None  # type: Dict[str, str]
+        self._config_expiration = 0
+
+    @property
+    def config(self):
+        # type: () -> ElasticsearchSettings
+        return self._get_config()[0]
+
+    def _get_config(self):
+        # type: () -> Tuple[ElasticsearchSettings, Dict[str, str]]
+        config, headers = self._config, self._headers
+        if config is None or self._config_expiration < time.time():
+            config = get_elasticsearch_config()
+            auth = base64.b64encode('%s:%s' % (config.auth_username, config.auth_password))
+            headers = {
+                'Accept': 'application/json',
+                'Authorization': 'Basic %s' % auth
+            }
+            self._config, self._headers = config, headers
+            self._config_expiration = time.time() + self.SETTINGS_TTL
+        return config, headers
+
+    def invalidate(self):
+        self._config = None
+        self._headers = None
+
+    def request_async(self, path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204),
+                      callback=None):
+        # type: (str, int, Union[Dict, str], Tuple[int], Callable) -> ElasticsearchRPC
+        config, headers = self._get_config()
+        headers = dict(headers)
+        if payload:
+            if isinstance(payload, basestring):
+                headers['Content-Type'] = 'application/x-ndjson'
+            else:
+                headers['Content-Type'] = 'application/json'
+        data = json.dumps(payload) if isinstance(payload, dict) else payload
+        url = config.base_url + path
+        if DEBUG:
+            if data:
+                logging.debug('%s\n%s', url, data)
+            else:
+                logging.debug(url)
+        rpc = urlfetch.create_rpc(deadline=30)
+        urlfetch.make_fetch_call(rpc, url, data, method, headers)
+        return ElasticsearchRPC(rpc, allowed_status_codes, callback)
+
+    def request(self, path, method=urlfetch.GET, payload=None, allowed_status_codes=(200, 204)):
+        # type: (str, int, Union[Dict, str], Tuple[int]) -> Dict
+        return self.request_async(path, method, payload, allowed_status_codes).get_result()
+
+
+class ElasticsearchRPC(object):
+
+    def __init__(self, rpc, allowed_status_codes, callback=None):
+        self.rpc = rpc
+        self.allowed_status_codes = allowed_status_codes
+        self.callback = callback
+
+    def get_result(self):
+        result = self.rpc.get_result()  # type: urlfetch._URLFetchResult
+        get_request_timer().count('search_bytes', len(result.content))
+        if result.status_code not in self.allowed_status_codes:
+            logging.debug(result.content)
+            raise Exception('Invalid response from elasticsearch: %s' % result.status_code)
+        if result.headers.get('Content-Type').startswith('application/json'):
+            content = json.loads(result.content)
         else:
-            logging.debug(url)
-    result = urlfetch.fetch(url, data, method, headers, deadline=30)  # type: urlfetch._URLFetchResult
-    if result.status_code not in allowed_status_codes:
-        logging.debug(result.content)
-        raise Exception('Invalid response from elasticsearch: %s' % result.status_code)
-    if result.headers.get('Content-Type').startswith('application/json'):
-        return json.loads(result.content)
-    return result.content
+            content = result.content
+        return self.callback(content) if self.callback else content
 
 
-def delete_doc_operations(uid):
-    yield {'delete': {'_id': uid}}
+_client = ElasticsearchClient()
+_mapping_updated = False
 
 
-def index_doc_operations(uid, doc):
-    yield {'index': {'_id': uid}}
-    yield doc
+def invalidate_elasticsearch_config():
+    # Other instances keep using their settings until SETTINGS_TTL has passed
+    _client.invalidate()
 
 
-def execute_bulk_request(operations):
-    # type: (Iterable[Dict]) -> List[Dict]
-    config = get_elasticsearch_config()
-    path = '/%s/_bulk' % config.items_index
+def execute_bulk_request(operations, raise_on_error=True):
+    # type: (Iterable[Dict], bool) -> List[Dict]
+    _ensure_mapping()
+    path = '/%s/_bulk' % _client.config.items_index
     # NDJSON - one operation per line
     payload = '\n'.join([json.dumps(op) for op in operations])
     payload += '\n'
-    result = _request(config, path, urlfetch.POST, payload)
+    callback = _process_bulk_result if raise_on_error else lambda result: result['items']
+    return _client.request_async(path, urlfetch.POST, payload, callback=callback).get_result()
+
+
+def _process_bulk_result(result):
+    # type: (Dict) -> List[Dict]
     if result['errors'] is True:
         logging.debug(result)
         # throw the first error found
@@ -93,102 +151,154 @@ def execute_bulk_request(operations):
 
 
 def delete_index():
-    config = get_elasticsearch_config()
-    path = '/%s' % config.items_index
-    return _request(config, path, urlfetch.DELETE)
-
-
-def create_index():
-    config = get_elasticsearch_config()
-    request = {
-        'mappings': {
-            'properties': {
-                'location': {
-                    'type': 'geo_point'
-                },
-                'start_date': {
-                    'type': 'date'
-                },
-                'end_date': {
-                    'type': 'date'
-                },
-                'time_frames': {
-                    'type': 'date_range'
+    path = '/%s' % _client.config.items_index
+    return _client.request(path, urlfetch.DELETE)
+
+
+def _get_mapping():
+    # type: () -> Dict
+    return {
+        'properties': {
+            'location': {
+                'type': 'geo_point'
+            },
+            'start_date': {
+                'type': 'date'
+            },
+            'end_date': {
+                'type': 'date'
+            },
+            'time_frames': {
+                'type': 'date_range'
+            },
+            'uid': {
+                'type': 'keyword'
+            },
+            'title': {
+                'type': 'text',
+                'index': False
+            },
+            'icon': {
+                'properties': {
+                    'id': {
+                        'type': 'keyword'
+                    },
+                    'color': {
+                        'type': 'keyword',
+                        'index': False
+                    }
                 }
+            },
+            'periods': {
+                'type': 'long',
+                'index': False,
+                'doc_values': False
             }
         }
     }
-    path = '/%s' % config.items_index
-    return _request(config, path, urlfetch.PUT, request)
-
-
-def delete_docs(uids):
-    operations = itertools.chain.from_iterable([delete_doc_operations(uid) for uid in uids])
-    return execute_bulk_request(operations)
-
 
-def index_documents(docs):
-    # type: (List[Tuple[str, Dict]]) -> List[Dict]
-    operations = itertools.chain.from_iterable([index_doc_operations(uid, doc) for uid, doc in docs])
-    return execute_bulk_request(operations)
 
-
-def perform_search(lat, lon, distance, start, end, cursor=None, limit=10, filter_type=ItemFilterType.RANGE):
-    new_cursor, result_data = _perform_search(lat, lon, distance, start, end, cursor, limit, filter_type)
-    keys = get_model_keys_from_search_result_ids([hit['_id'] for hit in result_data['hits']['hits']])
-    return keys, new_cursor
-
-
-def get_model_keys_from_search_result_ids(ids):
-    keys = set()
-    for uid in ids:
-        parts = uid.split('-')
-
-        if len(parts) == 2:
-            type_, gipod_id = parts
-        else:
-            type_, gipod_id, _ = parts
-
-        if type_ == 'w':
-            keys.add(WorkAssignment.create_key(WorkAssignment.TYPE, gipod_id))
-        elif type_ == 'm':
-            keys.add(Manifestation.create_key(Manifestation.TYPE, gipod_id))
-    if None in keys:
-        keys.remove(None)
-    return keys
-
-
-def _perform_search(lat, lon, distance, start, end, cursor, limit, filter_type):
-    # we can only fetch up to 10000 items with from param
-    start_offset = long(cursor) if cursor else 0
-
-    if (start_offset + limit) > 10000:
-        limit = 10000 - start_offset
-    if limit <= 0:
-        return {'cursor': None, 'ids': []}
+def create_index():
+    request = {
+        'mappings': _get_mapping()
+    }
+    path = '/%s' % _client.config.items_index
+    return _client.request(path, urlfetch.PUT, request)
+
+
+def _ensure_mapping():
+    # Every instance updates the mapping once, before it indexes its first documents
+    global _mapping_updated
+    if not _mapping_updated:
+        update_mapping()
+        _mapping_updated = True
+
+
+def update_mapping():
+    # Adds the fields that were added after the index was created (uid, title, icon, periods) to its mapping.
+    # This must happen before any document containing them is indexed, otherwise elasticsearch maps them dynamically
+    # (e.g. uid and icon.id as text) and sorting and clustering on them fails. That's why every bulk request
+    # makes sure this was done first.
+    # Fields that were already mapped dynamically can't be changed, the index must then be deleted and created again.
+    path = '/%s/_mapping' % _client.config.items_index
+    current_mapping = _client.request(path).values()[0]['mappings']
+    wrong_fields = get_wrong_field_types(_get_mapping(), current_mapping)
+    if wrong_fields:
+        raise Exception('Index %s must be deleted and created again, these fields have the wrong type: %s'
+                        % (_client.config.items_index, ', '.join(sorted(wrong_fields))))
+    return _client.request(path, urlfetch.PUT, _get_mapping())
+
+
+def get_wrong_field_types(expected_mapping, current_mapping, prefix=''):
+    # type: (Dict, Dict, str) -> List[str]
+    # Returns the fields that exist in both mappings with a different type, e.g. icon.id that was mapped as text
+    wrong_fields = []
+    current_properties = current_mapping.get('properties') or {}
+    for name, expected in expected_mapping['properties'].iteritems():
+        current = current_properties.get(name)
+        if not current:
+            continue
+        if current.get('type', 'object') != expected.get('type', 'object'):
+            wrong_fields.append(prefix + name)
+        elif 'properties' in expected:
+            wrong_fields.extend(get_wrong_field_types(expected, current, prefix + name + '.'))
+    return wrong_fields
+
+
+def search_items(lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox=None, sort=None):
+    # type: (float, float, int, str, str, str, int, str, Union[bool, List[str]], Dict, str) -> Tuple[unicode, List]
+    start_offset, search_after = parse_cursor(cursor)
+    if search_after is None:
+        # Offset cursors created before search_after was used. We can only fetch up to 10000 items with from param.
+        if (start_offset + limit) > 10000:
+            limit = 10000 - start_offset
+        if limit <= 0:
+            return None, []
 
     query = {
+        '_source': source,
         'size': limit,
-        'from': start_offset,
+        'track_total_hits': False,
         'query': {
             'bool': {
                 'must': {
                     'match_all': {}
                 },
-                'filter': [
-                    {
-                        'geo_distance': {
-                            'distance': '%sm' % distance,
-                            'location': {
-                                'lat': lat,
-                                'lon': lon
-                            }
-                        }
-                    }
-                ]
+                'filter': _get_search_filters(lat, lon, distance, start, end, filter_type, bbox)
             }
         },
-        'sort': [{
+        'sort': _get_search_sort(lat, lon, bbox, sort)
+    }
+    if search_after is None:
+        query['from'] = start_offset
+    else:
+        query['search_after'] = search_after
+
+    path = '/%s/_search' % _client.config.items_index
+    result_data = _client.request(path, urlfetch.POST, query)
+
+    hits = result_data['hits']['hits']
+    new_cursor = None
+    if hits and len(hits) == limit:
+        new_cursor = create_cursor(hits[-1]['sort'])
+    return new_cursor, hits
+
+
+def _get_search_sort(lat, lon, bbox, sort):
+    # type: (float, float, Dict, str) -> List[Dict]
+    if not sort:
+        # Sorting on distance isn't needed to fill a viewport
+        sort = ItemSort.NONE if bbox else ItemSort.DISTANCE
+    # Tiebreaker so search_after never skips or repeats items with the same sort values
+    sort_values = [{
+        'uid': {
+            'order': 'asc',
+            'missing': '_last',
+            'unmapped_type': 'keyword'
+        }
+    }]
+    if sort == ItemSort.DISTANCE:
+        sort_values.insert(0, {
             '_geo_distance': {
                 'location': {
                     'lat': lat,
@@ -197,11 +307,49 @@ def _perform_search(lat, lon, distance, start, end, cursor, limit, filter_type):
                 'order': 'asc',
                 'unit': 'm'
             }
-        }]
-    }
-
+        })
+    elif sort == ItemSort.START_DATE:
+        sort_values.insert(0, {
+            'start_date': {
+                'order': 'asc'
+            }
+        })
+    return sort_values
+
+
+def _get_search_filters(lat, lon, distance, start, end, filter_type, bbox=None):
+    # type: (float, float, int, str, str, str, Dict) -> List[Dict]
+    if bbox:
+        filters = [
+            {
+                'geo_bounding_box': {
+                    'location': {
+                        'top_left': {
+                            'lat': bbox['north'],
+                            'lon': bbox['west']
+                        },
+                        'bottom_right': {
+                            'lat': bbox['south'],
+                            'lon': bbox['east']
+                        }
+                    }
+                }
+            }
+        ]
+    else:
+        filters = [
+            {
+                'geo_distance': {
+                    'distance': '%sm' % distance,
+                    'location': {
+                        'lat': lat,
+                        'lon': lon
+                    }
+                }
+            }
+        ]
     if filter_type == ItemFilterType.START_DATE:
-        query['query']['bool']['filter'].append({
+        filters.append({
             'range': {
                 'start_date': {
                     'gte': start,
@@ -218,20 +366,63 @@ def _perform_search(lat, lon, distance, start, end, cursor, limit, filter_type):
         if end:
             tf['lte'] = end
 
-        query['query']['bool']['filter'].append({
+        filters.append({
             'range': {
                 'time_frames': tf
             }
         })
+    return filters
 
-    config = get_elasticsearch_config()
-    path = '/%s/_search' % config.items_index
-    result_data = _request(config, path, urlfetch.POST, query)
 
-    new_cursor = None
-    next_offset = start_offset + len(result_data['hits']['hits'])
-    if result_data['hits']['total']['relation'] in ('eq', 'gte'):
-        if result_data['hits']['total']['value'] > next_offset and next_offset < 10000:
-            new_cursor = u'%s' % next_offset
+def search_clusters(lat, lon, distance, start, end, zoom, filter_type=ItemFilterType.RANGE, bbox=None):
+    # type: (float, float, int, str, str, int, str, Dict) -> List[Dict]
+    precision = get_cluster_precision(zoom)
+    query = {
+        'size': 0,
+        'track_total_hits': False,
+        'query': {
+            'bool': {
+                'filter': _get_search_filters(lat, lon, distance, start, end, filter_type, bbox)
+            }
+        },
+        'aggs': {
+            'clusters': {
+                'geotile_grid': {
+                    'field': 'location',
+                    'precision': precision,
+                    'size': MAX_CLUSTERS
+                },
+                'aggs': {
+                    'centroid': {
+                        'geo_centroid': {
+                            'field': 'location'
+                        }
+                    },
+                    'icons': {
+                        'terms': {
+                            'field': 'icon.id',
+                            'size': 1
+                        }
+                    }
+                }
+            }
+        }
+    }
+    path = '/%s/_search' % _client.config.items_index
+    result_data = _client.request(path, urlfetch.POST, query)
+    return result_data['aggregations']['clusters']['buckets']
+
+
+class ElasticsearchBackend(SearchBackend):
+
+    def search_items(self, lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox=None, sort=None):
+        return search_items(lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox, sort)
+
+    def search_clusters(self, lat, lon, distance, start, end, zoom, filter_type, bbox=None):
+        return search_clusters(lat, lon, distance, start, end, zoom, filter_type, bbox)
+
+    def execute_bulk_request(self, operations, raise_on_error=True):
+        return execute_bulk_request(operations, raise_on_error)
 
-    return new_cursor, result_data
+    def update_mapping(self):
+        update_mapping()
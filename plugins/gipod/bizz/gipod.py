@@ -16,13 +16,19 @@
 # @@license_version:1.5@@
 
 from datetime import datetime
+import array
+import bisect
+import heapq
+import itertools
+import json
 import logging
 
 from dateutil.parser import parse as parse_datetime
 from dateutil.relativedelta import relativedelta
 from google.appengine.datastore import datastore_rpc
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb, deferred
-from typing import Type, Union, Tuple, List, Iterable
+from typing import Type, Union, Tuple, List, Iterable, Dict, Set
 
 from framework.bizz.job import run_job, MODE_BATCH
 from framework.consts import HIGH_LOAD_CONTROLLER_QUEUE
@@ -30,12 +36,24 @@ from framework.utils import chunks
 from framework.utils.cloud_tasks import create_task, run_tasks, schedule_tasks
 from mcfw.consts import DEBUG
 from mcfw.rpc import arguments
-from plugins.gipod.bizz import do_request, validate_and_clean_data, do_request_without_processing
-from plugins.gipod.bizz.elasticsearch import delete_docs, index_doc_operations, delete_doc_operations, \
-    execute_bulk_request
-from plugins.gipod.models import Manifestation, SyncSettings, WorkAssignment
-from plugins.gipod.plugin_consts import SYNC_QUEUE
-
+from plugins.gipod.bizz import do_request, validate_and_clean_data, \
+    create_map_item, create_geometry_levels, do_requests_async, get_data_hash, set_item_periods, \
+    pack_item_geometries
+from plugins.gipod.bizz.search import delete_docs, index_doc_operations, delete_doc_operations, \
+    execute_bulk_request, get_bulk_errors, get_search_backend
+from plugins.gipod.bizz.details_cache import invalidate_item_details
+from plugins.gipod.bizz.search_cache import invalidate_search_cache
+from plugins.gipod.models import Manifestation, SyncSettings, WorkAssignment, MapItem, BaseModel, SyncMode
+from plugins.gipod.plugin_consts import SYNC_QUEUE, SYNC_BATCH_SIZE, SYNC_FETCH_CONCURRENCY
+from plugins.gipod.utils import get_epoch_from_datetime
+
+
+CLEANUP_BATCH_SIZE = 50
+CLEANUP_FETCH_CONCURRENCY = 10
+CLEANUP_FETCH_DEADLINE = 5  # seconds
+# Items that failed to update are retried in a new task, with a countdown that doubles every time
+MAX_UPDATE_RETRIES = 5
+UPDATE_RETRY_COUNTDOWN = 60  # seconds
 
 mapping = {
     Manifestation.TYPE: {
@@ -61,8 +79,10 @@ def sync():
             return
     last_sync = settings.synced_until
 
-    tasks = [create_task(_sync_all, Manifestation.TYPE, last_sync, 0),
-             create_task(_sync_all, WorkAssignment.TYPE, last_sync, 0)]
+    mode = settings.mode or SyncMode.TASKS
+    concurrency = settings.fetch_concurrency or SYNC_FETCH_CONCURRENCY
+    tasks = [create_task(_sync_all, Manifestation.TYPE, last_sync, 0, mode, concurrency),
+             create_task(_sync_all, WorkAssignment.TYPE, last_sync, 0, mode, concurrency)]
     run_tasks(tasks)
 
     settings.synced_until = datetime.now()
@@ -98,7 +118,9 @@ def cleanup_deleted():
         cls = m['class']
         per_page = 2000
         params = {'limit': '%s' % per_page, 'enddate': end_date.strftime('%Y-%m-%d')}
-        gipod_ids = set()
+        # Sorted array of integers instead of a set of strings, to keep memory usage low with lots of items.
+        # Every page is sorted on its own and the pages are merged, so there never is a list of all ids.
+        pages = []
         offset = 0
         while True:
             items = do_request(url, params)
@@ -106,26 +128,46 @@ def cleanup_deleted():
                 break
             offset += per_page
             params['offset'] = '%d' % offset
-            for item in items:
-                gipod_ids.add(cls.create_key(type, item['gipodId']).id())
+            pages.append(array.array('l', sorted(long(item['gipodId']) for item in items)))
         # Note: this api is not great and returns different results when using 'offset'
         # Not using offset causes memory usage to skyrocket so we can't do that
+        gipod_ids = array.array('l', heapq.merge(*pages))
+        del pages
         logging.debug('Found %d %s items on gipod', len(gipod_ids), cls._get_kind())
-        our_item_keys = {key for key in fetch_iter(cls.list())}
         to_delete = []
-        for our_key in our_item_keys:
-            if our_key.id() not in gipod_ids:
-                to_delete.append(our_key)
+        tasks = []
+        deleted_count = 0
+        for our_key in fetch_iter(cls.list()):
+            if _contains_gipod_id(gipod_ids, our_key):
+                continue
+            to_delete.append(our_key)
+            deleted_count += 1
+            if len(to_delete) == CLEANUP_BATCH_SIZE:
+                tasks.append(create_task(cleanup_deleted_worker, to_delete))
+                to_delete = []
+                if len(tasks) == 100:
+                    schedule_tasks(tasks, SYNC_QUEUE)
+                    tasks = []
         if to_delete:
-            logging.debug('Marking %s %s as deleted', len(to_delete), cls._get_kind())
-            tasks = []
-            for keys_chunk in chunks(to_delete, 50):
-                tasks.append(create_task(cleanup_deleted_worker, keys_chunk))
+            tasks.append(create_task(cleanup_deleted_worker, to_delete))
+        if tasks:
             schedule_tasks(tasks, SYNC_QUEUE)
+        if deleted_count:
+            logging.debug('Marked %s %s as deleted', deleted_count, cls._get_kind())
+
 
+def _contains_gipod_id(sorted_gipod_ids, key):
+    # type: (array.array, ndb.Key) -> bool
+    try:
+        gipod_id = long(key.id().split('-')[1])
+    except (IndexError, ValueError):
+        return False
+    i = bisect.bisect_left(sorted_gipod_ids, gipod_id)
+    return i < len(sorted_gipod_ids) and sorted_gipod_ids[i] == gipod_id
 
-def _sync_all(item_type, last_sync, offset):
-    # type: (str, datetime, int) -> None
+
+def _sync_all(item_type, last_sync, offset, mode=SyncMode.TASKS, concurrency=SYNC_FETCH_CONCURRENCY):
+    # type: (str, datetime, int, str, int) -> None
     end_date = datetime.now() + (relativedelta(days=1) if DEBUG else relativedelta(months=12))
     params = {
         'enddate': end_date.strftime('%Y-%m-%d'),
@@ -133,101 +175,287 @@ def _sync_all(item_type, last_sync, offset):
         'offset': '%s' % offset
     }
 
-    tasks = []
     url = mapping[item_type]['list']
     items = do_request(url, params)
+    updated_ids = []
+    new_ids = []
     for item in items:
         if last_sync:
             d = parse_datetime(item['latestUpdate'])
             if last_sync > d:
-                tasks.append(create_task(_update_one, item_type, str(item['gipodId']), skip_if_exists=True))
+                new_ids.append(str(item['gipodId']))
                 continue
 
-        tasks.append(create_task(_update_one, item_type, str(item['gipodId'])))
+        updated_ids.append(str(item['gipodId']))
 
-    run_tasks(tasks, SYNC_QUEUE)
+    if mode == SyncMode.PAGE:
+        _sync_page(item_type, updated_ids, new_ids, concurrency)
+    else:
+        tasks = [create_task(_update_many, item_type, ids_chunk)
+                 for ids_chunk in chunks(updated_ids, SYNC_BATCH_SIZE)]
+        tasks.extend(create_task(_update_many, item_type, ids_chunk, skip_if_exists=True)
+                     for ids_chunk in chunks(new_ids, SYNC_BATCH_SIZE))
+        run_tasks(tasks, SYNC_QUEUE)
 
     if len(items) > 0:
-        deferred.defer(_sync_all, item_type, last_sync, offset + len(items), _queue=HIGH_LOAD_CONTROLLER_QUEUE)
+        # Only scheduled once this page is done, so there is one page in flight per type. Items that fail are retried
+        # separately, so they don't stop the next pages. The name prevents a retry of this task from starting a second
+        # chain of pages.
+        next_offset = offset + len(items)
+        task_name = 'gipod-sync-%s-%s-%d' % (item_type, last_sync.strftime('%Y%m%d%H%M%S%f') if last_sync else 'all',
+                                             next_offset)
+        try:
+            deferred.defer(_sync_all, item_type, last_sync, next_offset, mode, concurrency, _name=task_name,
+                           _queue=HIGH_LOAD_CONTROLLER_QUEUE)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info('Next page was already scheduled: %s', task_name)
+
+
+def _sync_page(item_type, updated_ids, new_ids, concurrency):
+    # type: (str, List[str], List[str], int) -> None
+    # Updates all items of a page in this request instead of scheduling a task per batch
+    models = itertools.chain(_iter_models_to_update(item_type, updated_ids, False),
+                             _iter_models_to_update(item_type, new_ids, True))
+    _retry_failed_ids(item_type, _update_models(item_type, models, concurrency), 0)
 
 
 def _update_one(item_type, gipod_id, skip_if_exists=False):
-    item = mapping[item_type]
-    clazz = item['class']
-    key = clazz.create_key(clazz.TYPE, gipod_id)
-    model = key.get()
-    if model and skip_if_exists:
-        return
-    if not model:
-        model = clazz(key=key)
+    _update_many(item_type, [gipod_id], skip_if_exists)
+
 
-    model.data = do_request(item['detail'] % gipod_id)
-    validate_and_clean_data(model.TYPE, model.uid, model.data)
-    updated_model, es_operations = re_index_model(model)
-    updated_model.put()
-    execute_bulk_request(es_operations)
+def _update_many(item_type, gipod_ids, skip_if_exists=False, retry_count=0):
+    # type: (str, List[str], bool, int) -> None
+    models = _iter_models_to_update(item_type, gipod_ids, skip_if_exists)
+    _retry_failed_ids(item_type, _update_models(item_type, models, SYNC_FETCH_CONCURRENCY), retry_count)
+
+
+def _retry_failed_ids(item_type, failed_ids, retry_count):
+    # type: (str, List[str], int) -> None
+    # Only the items that failed are retried, instead of the whole batch
+    if not failed_ids:
+        return
+    if retry_count >= MAX_UPDATE_RETRIES:
+        logging.error('Giving up on %d %s items after %d retries: %s', len(failed_ids), item_type, retry_count,
+                      failed_ids)
+        return
+    logging.info('Retrying %d items that failed to update', len(failed_ids))
+    for ids_chunk in chunks(failed_ids, SYNC_BATCH_SIZE):
+        deferred.defer(_update_many, item_type, ids_chunk, False, retry_count + 1, _queue=SYNC_QUEUE,
+                       _countdown=UPDATE_RETRY_COUNTDOWN * 2 ** retry_count)
+
+
+def _iter_models_to_update(item_type, gipod_ids, skip_if_exists):
+    # type: (str, List[str], bool) -> Iterable[BaseModel]
+    # Loads the models per batch
+    clazz = mapping[item_type]['class']
+    for ids_chunk in chunks(gipod_ids, SYNC_BATCH_SIZE):
+        keys = [clazz.create_key(clazz.TYPE, gipod_id) for gipod_id in ids_chunk]
+        for key, model in zip(keys, ndb.get_multi(keys)):
+            if model and skip_if_exists:
+                continue
+            yield model or clazz(key=key)
+
+
+def _update_models(item_type, models, concurrency):
+    # type: (str, Iterable[BaseModel], int) -> List[str]
+    # Fetches the details of the models concurrently and saves them per batch as the results come in.
+    # Returns the gipod ids of the items that failed to update.
+    detail_url = mapping[item_type]['detail']
+    pending = {}
+
+    def get_urls():
+        for m in models:
+            relative_url = detail_url % m.gipod_id
+            pending[relative_url] = m
+            yield relative_url
+
+    updated_models = []
+    # Coordinates of the updated models before they were updated, per uid
+    old_coordinates = {}
+    # Models of which the data changed, and not only the cleanup date
+    changed_uids = set()
+    failed_ids = []
+    now_ = datetime.utcnow()
+    for relative_url, result in do_requests_async(get_urls(), concurrency):
+        model = pending.pop(relative_url)
+        if not isinstance(result, Exception) and result.status_code == 404:
+            # Removed from gipod after the list was fetched, cleanup_deleted takes care of it
+            logging.info('Item %s no longer exists on gipod', model.uid)
+            continue
+        if isinstance(result, Exception) or result.status_code != 200:
+            logging.error('Failed to get gipod data for %s: %s', model.uid,
+                          result if isinstance(result, Exception) else result.status_code)
+            failed_ids.append(model.gipod_id)
+            continue
+        try:
+            previous_coordinates = _get_coordinates(model) if model.data else None
+            data = json.loads(result.content)
+            validate_and_clean_data(model.TYPE, model.uid, data)
+            data_hash = get_data_hash(data)
+            if data_hash == model.data_hash:
+                # Nothing changed on gipod, only re-index when the cleanup date has to move (e.g. a period ended)
+                _, cleanup_date = _get_index_periods(model.TYPE, create_map_item(model), now_)
+                if cleanup_date == model.cleanup_date:
+                    continue
+            else:
+                model.data = data
+                model.data_hash = data_hash
+                model.geometry_levels = create_geometry_levels(model.data)
+                set_item_periods(model)
+                pack_item_geometries(model)
+                changed_uids.add(model.uid)
+        except Exception:
+            # A malformed item shouldn't stop the others from being updated
+            logging.exception('Failed to update %s', model.uid)
+            failed_ids.append(model.gipod_id)
+            continue
+        updated_models.append(model)
+        if previous_coordinates:
+            old_coordinates[model.uid] = previous_coordinates
+        if len(updated_models) >= SYNC_BATCH_SIZE:
+            failed_ids.extend(_save_updated_models(updated_models, old_coordinates, changed_uids))
+            updated_models = []
+            old_coordinates = {}
+            changed_uids = set()
+
+    failed_ids.extend(_save_updated_models(updated_models, old_coordinates, changed_uids))
+    return failed_ids
+
+
+def _save_updated_models(models, old_coordinates, changed_uids):
+    # type: (List[BaseModel], Dict[unicode, Tuple[float, float]], Set[unicode]) -> List[str]
+    # Indexes the models in one bulk request, and only saves the ones that were indexed successfully.
+    # The models in changed_uids are marked as modified (see bizz.delta).
+    # Only the search cache cells of the saved models, at their old and new coordinates, are invalidated.
+    # Returns the gipod ids of the models that failed to index.
+    if not models:
+        return []
+    to_put = {}
+    operations = []
+    failed_ids = []
+    for model in models:
+        try:
+            updated_model, map_item, es_operations = re_index_model(model)
+        except Exception:
+            logging.exception('Failed to create the map item of %s', model.uid)
+            failed_ids.append(model.gipod_id)
+            continue
+        to_put[model.uid] = (updated_model, map_item)
+        operations.extend(es_operations)
+    if not to_put:
+        return failed_ids
+    errors = get_bulk_errors(execute_bulk_request(operations, raise_on_error=False))
+    for uid, reason in errors.iteritems():
+        logging.error('Failed to index %s: %s', uid, reason)
+        failed = to_put.pop(uid, None)
+        if failed:
+            failed_ids.append(failed[0].gipod_id)
+    # Set right before saving, so a delta that still saw the old data was taken before this time
+    modified = datetime.utcnow()
+    for uid in changed_uids:
+        if uid in to_put:
+            for m in to_put[uid]:
+                m.modified = modified
+    ndb.put_multi([m for models_to_put in to_put.itervalues() for m in models_to_put])
+    coordinates = [(map_item.lat, map_item.lon) for _, map_item in to_put.itervalues()]
+    coordinates.extend(old_coordinates[uid] for uid in to_put if uid in old_coordinates)
+    invalidate_search_cache(coordinates)
+    invalidate_item_details(to_put.keys())
+    return failed_ids
+
+
+def _get_coordinates(model):
+    # type: (BaseModel) -> Tuple[float, float]
+    lon, lat = model.data['location']['coordinate']['coordinates'][:2]
+    return lat, lon
 
 
 def re_index(keys):
     models = ndb.get_multi(keys)
     to_put = []
     operations = []
+    coordinates = []
     for model in models:
-        updated_model, es_operations = re_index_model(model)
-        to_put.append(updated_model)
+        updated_model, map_item, es_operations = re_index_model(model)
+        to_put.extend((updated_model, map_item))
         operations.extend(es_operations)
+        coordinates.append((map_item.lat, map_item.lon))
     ndb.put_multi(to_put)
     execute_bulk_request(operations)
+    invalidate_search_cache(coordinates)
+    invalidate_item_details([key.id() for key in keys])
 
 
 @arguments(item=(WorkAssignment, Manifestation))
 def re_index_model(item):
-    # type: (Union[WorkAssignment, Manifestation]) -> Tuple[Union[WorkAssignment, Manifestation], Iterable[dict]]
-    item.cleanup_date = None
-    operations = None
-    now_ = datetime.utcnow()
+    # type: (Union[WorkAssignment, Manifestation]) -> Tuple[BaseModel, MapItem, Iterable[dict]]
+    if not item.start_dates:
+        # Saved before the periods were stored on the model
+        set_item_periods(item)
+    if not item.packed_geometries and item.data['location']['geometry']:
+        # Saved before the geometries were packed
+        pack_item_geometries(item)
+    map_item = create_map_item(item)
+    periods, item.cleanup_date = _get_index_periods(item.TYPE, map_item, datetime.utcnow())
+    if periods:
+        operations = _index_item(map_item, periods)
+    else:
+        operations = delete_doc_operations(item.uid)
+    return item, map_item, operations
 
-    if isinstance(item, Manifestation):
-        periods = []
-        for period in item.data['periods']:
-            start_date = parse_datetime(period['startDateTime'])
-            end_date = parse_datetime(period['endDateTime'])
-            if end_date <= now_:
-                continue
-            if not item.cleanup_date or item.cleanup_date > end_date:
-                item.cleanup_date = end_date
-            periods.append((start_date, end_date))
+
+def get_map_item_index_operations(map_items):
+    # type: (Iterable[MapItem]) -> Iterable[dict]
+    # Same documents as re_index_model creates, but only using the MapItems. Used to (re)build in-process indexes.
+    now_ = datetime.utcnow()
+    for map_item in map_items:
+        type_ = map_item.uid.split('-')[0]
+        periods, _ = _get_index_periods(type_, map_item, now_)
         if periods:
-            operations = _index_item(item, periods)
-    elif isinstance(item, WorkAssignment):
-        start_date = parse_datetime(item.data['startDateTime'])
-        end_date = parse_datetime(item.data['endDateTime'])
-        item.cleanup_date = end_date
-        operations = _index_item(item, [(start_date, end_date)])
-
-    if not operations:
-        operations = delete_doc_operations(item.uid)
-    return item, operations
+            for operation in _index_item(map_item, periods):
+                yield operation
 
 
-def _index_item(item, periods):
-    # type: (Union[WorkAssignment, Manifestation], List[Tuple[datetime, datetime]]) -> dict
+def _get_index_periods(type_, map_item, now_):
+    # type: (str, MapItem, datetime) -> Tuple[List[Tuple[datetime, datetime]], datetime]
+    # Returns the periods that should be indexed, and the date on which the item must be re-indexed
+    if type_ == Manifestation.TYPE:
+        periods = [(start_date, end_date) for start_date, end_date in map_item.periods if end_date > now_]
+        cleanup_date = min(end_date for _, end_date in periods) if periods else None
+        return periods, cleanup_date
+    elif type_ == WorkAssignment.TYPE:
+        return map_item.periods, map_item.periods[0][1]
+    return [], None
+
+
+def _index_item(map_item, periods):
+    # type: (MapItem, List[Tuple[datetime, datetime]]) -> dict
     time_frames = [{'gte': start_date.isoformat() + 'Z', 'lte': end_date.isoformat() + 'Z'}
                    for start_date, end_date in periods]
-    data = item.data
     doc = {
+        'uid': map_item.uid,
         'location': {
-            'lat': data['location']['coordinate']['coordinates'][1],
-            'lon': data['location']['coordinate']['coordinates'][0]
+            'lat': map_item.lat,
+            'lon': map_item.lon
         },
         'start_date': time_frames[0]['gte'],
         'end_date': time_frames[0]['lte'],
         'time_frames': time_frames,
+        # Only stored in _source, used to render search results without loading anything from the datastore
+        'title': map_item.title,
+        'icon': {
+            'id': map_item.icon_id,
+            'color': map_item.icon_color
+        },
+        'periods': [[get_epoch_from_datetime(start_date), get_epoch_from_datetime(end_date)]
+                    for start_date, end_date in map_item.periods],
     }
-    return index_doc_operations(item.uid, doc)
+    return index_doc_operations(map_item.uid, doc)
 
 
 def re_index_all():
+    # Fails early when the index has to be created again, instead of in every re_index task
+    get_search_backend().update_mapping()
     run_job(re_index_query, [Manifestation], re_index, [], mode=MODE_BATCH)
     run_job(re_index_query, [WorkAssignment], re_index, [], mode=MODE_BATCH)
 
@@ -244,15 +472,28 @@ def cleanup_timed_out_query(clazz, current_date):
 
 def cleanup_deleted_worker(keys):
     to_delete = []
+    transient_errors = 0
     # Gipod api does always not return the same results when doing the same query twice.
     # For this reason we doublecheck if an item is deleted or not by fetching its details.
+    keys_by_url = {}
     for key in keys:
         type_, gipod_id = key.id().split('-')
-        item = mapping[type_]
-        result = do_request_without_processing(item['detail'] % gipod_id)
-        if result.status_code == 404:
+        keys_by_url[mapping[type_]['detail'] % gipod_id] = key
+    for relative_url, result in do_requests_async(keys_by_url.keys(), CLEANUP_FETCH_CONCURRENCY,
+                                                  CLEANUP_FETCH_DEADLINE):
+        key = keys_by_url[relative_url]
+        if isinstance(result, Exception) or result.status_code >= 500:
+            # Will be checked again by the next cleanup
+            logging.warn('Could not verify if %s is deleted: %s', key.id(),
+                         result if isinstance(result, Exception) else result.status_code)
+            transient_errors += 1
+        elif result.status_code == 404:
             to_delete.append(key)
-    logging.debug('Removing %d/%d items', len(to_delete), len(keys))
+    logging.debug('Removing %d/%d items (%d could not be verified)', len(to_delete), len(keys), transient_errors)
     if to_delete:
+        map_item_keys = [MapItem.create_key(key.id()) for key in to_delete]
+        coordinates = [(m.lat, m.lon) for m in ndb.get_multi(map_item_keys) if m]
         delete_docs([key.id() for key in to_delete])
-        ndb.delete_multi(to_delete)
+        ndb.delete_multi(to_delete + map_item_keys)
+        invalidate_search_cache(coordinates)
+        invalidate_item_details([key.id() for key in to_delete])
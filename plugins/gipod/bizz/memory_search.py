@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import bisect
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, Counter
+
+from dateutil.parser import parse as parse_datetime
+from dateutil.tz import tzutc
+from typing import Dict, Tuple, Iterable, List, Union, Callable
+
+from plugins.gipod.bizz.search import SearchBackend, create_cursor, parse_cursor, get_cluster_precision, MAX_CLUSTERS
+from plugins.gipod.models import ItemFilterType, ItemSort, MapItem
+from plugins.gipod.utils import get_epoch_from_datetime
+
+# Same earth radius as elasticsearch, so distances (and thus the results) are the same for both backends
+EARTH_RADIUS = 6371008.7714  # meters
+CELL_SIZE = 0.01  # degrees, ~1km
+# Every instance has its own index. It is rebuilt from the datastore periodically to include the changes made by
+# other instances. The request that notices the index expired rebuilds it, the others keep using the old index.
+INDEX_TTL = 600  # seconds
+LOAD_BATCH_SIZE = 500
+
+
+class _Document(object):
+    __slots__ = ('uid', 'lat', 'lon', 'cell', 'start_date', 'frame_starts', 'frame_ends', 'source')
+
+    def __init__(self, uid, source):
+        # type: (unicode, Dict) -> None
+        self.uid = uid
+        self.source = source
+        self.lat = source['location']['lat']
+        self.lon = source['location']['lon']
+        self.cell = _get_cell(self.lat, self.lon)
+        self.start_date = _get_timestamp(source['start_date'])
+        frames = sorted((_get_timestamp(tf['gte']), _get_timestamp(tf['lte'])) for tf in source['time_frames'])
+        self.frame_starts = [start for start, _ in frames]
+        self.frame_ends = [end for _, end in frames]
+
+    def matches_time_frames(self, start, end):
+        # type: (float, float) -> bool
+        # Frames are sorted on their start, so only the frames that started before the end of the query can match
+        count = len(self.frame_starts) if end is None else bisect.bisect_right(self.frame_starts, end)
+        if start is None:
+            return count > 0
+        for i in xrange(count):
+            if self.frame_ends[i] >= start:
+                return True
+        return False
+
+    def matches_start_date(self, start, end):
+        # type: (float, float) -> bool
+        return (start is None or self.start_date >= start) and (end is None or self.start_date < end)
+
+    def get_source(self, source):
+        # type: (Union[bool, List[str]]) -> Dict
+        if source is False:
+            return None
+        if source is True:
+            return self.source
+        return {field: self.source[field] for field in source if field in self.source}
+
+
+class SpatioTemporalIndex(object):
+    # Items are put in a grid of CELL_SIZE degrees. Queries only check the items in the cells covering their area.
+
+    def __init__(self):
+        self.documents = {}  # type: Dict[unicode, _Document]
+        self.cells = defaultdict(set)  # type: Dict[Tuple[int, int], set]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, uid, source):
+        # type: (unicode, Dict) -> None
+        self.remove(uid)
+        doc = _Document(uid, source)
+        self.documents[uid] = doc
+        self.cells[doc.cell].add(uid)
+
+    def remove(self, uid):
+        # type: (unicode) -> bool
+        doc = self.documents.pop(uid, None)
+        if not doc:
+            return False
+        cell = self.cells[doc.cell]
+        cell.discard(uid)
+        if not cell:
+            del self.cells[doc.cell]
+        return True
+
+    def find(self, lat, lon, distance, start, end, filter_type, bbox=None):
+        # type: (float, float, int, str, str, str, Dict) -> Iterable[Tuple[_Document, float]]
+        # Yields the matching documents with their distance to lat, lon
+        if bbox:
+            north, east, south, west = bbox['north'], bbox['east'], bbox['south'], bbox['west']
+        else:
+            lat_delta = math.degrees(float(distance) / EARTH_RADIUS)
+            lon_delta = lat_delta / max(math.cos(math.radians(min(abs(lat) + lat_delta, 90))), 1e-6)
+            north, south = lat + lat_delta, lat - lat_delta
+            east, west = lon + lon_delta, lon - lon_delta
+        start_ts = _get_timestamp(start)
+        end_ts = _get_timestamp(end)
+        for doc in self._get_candidates(north, east, south, west):
+            if not (south <= doc.lat <= north and west <= doc.lon <= east):
+                continue
+            doc_distance = _get_distance(lat, lon, doc.lat, doc.lon) if lat is not None else 0
+            if not bbox and doc_distance > distance:
+                continue
+            if filter_type == ItemFilterType.START_DATE:
+                if not doc.matches_start_date(start_ts, end_ts):
+                    continue
+            elif not doc.matches_time_frames(start_ts, end_ts):
+                continue
+            yield doc, doc_distance
+
+    def _get_candidates(self, north, east, south, west):
+        # type: (float, float, float, float) -> Iterable[_Document]
+        min_cell = _get_cell(south, west)
+        max_cell = _get_cell(north, east)
+        cell_count = (max_cell[0] - min_cell[0] + 1) * (max_cell[1] - min_cell[1] + 1)
+        if cell_count > len(self.cells):
+            # Large areas, cheaper to check every non-empty cell than every cell in the area
+            cells = [cell for cell in self.cells
+                     if min_cell[0] <= cell[0] <= max_cell[0] and min_cell[1] <= cell[1] <= max_cell[1]]
+        else:
+            cells = [(x, y) for x in xrange(min_cell[0], max_cell[0] + 1)
+                     for y in xrange(min_cell[1], max_cell[1] + 1) if (x, y) in self.cells]
+        for cell in cells:
+            for uid in self.cells[cell]:
+                yield self.documents[uid]
+
+
+class MemorySearchBackend(SearchBackend):
+    # Keeps all indexed items in memory. Meant for local development and deployments that are too small to justify an
+    # elasticsearch cluster. Results, sorting and cursors behave like they do in the elasticsearch backend.
+
+    def __init__(self, loader=None):
+        # type: (Callable[[], Iterable[Dict]]) -> None
+        self._loader = loader or _load_index_operations
+        # Held while the index is read or changed, but not while it is loaded
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._index = None  # type: SpatioTemporalIndex
+        self._loaded_at = 0
+        # Bulk operations received while the index is loading, applied to the new index before it is used
+        self._pending_operations = None  # type: List[Dict]
+
+    def _get_index(self):
+        # type: () -> SpatioTemporalIndex
+        with self._lock:
+            index = self._index
+            if index is not None and time.time() - self._loaded_at <= INDEX_TTL:
+                return index
+        # Only waits for the load when there is no index yet
+        if not self._load_lock.acquire(index is None):
+            return index
+        try:
+            with self._lock:
+                if self._index is not index:
+                    # Loaded by another request in the meantime
+                    return self._index
+                self._pending_operations = []
+            new_index = SpatioTemporalIndex()
+            try:
+                self._apply_operations(new_index, self._loader())
+            except Exception:
+                with self._lock:
+                    self._pending_operations = None
+                raise
+            with self._lock:
+                self._apply_operations(new_index, self._pending_operations)
+                self._pending_operations = None
+                self._index = new_index
+                self._loaded_at = time.time()
+            logging.debug('Loaded %d items in the search index', len(new_index))
+            return new_index
+        finally:
+            self._load_lock.release()
+
+    def search_items(self, lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox=None, sort=None):
+        start_offset, search_after = parse_cursor(cursor)
+        if not sort:
+            sort = ItemSort.NONE if bbox else ItemSort.DISTANCE
+        index = self._get_index()
+        with self._lock:
+            results = []
+            for doc, doc_distance in index.find(lat, lon, distance, start, end, filter_type, bbox):
+                if sort == ItemSort.DISTANCE:
+                    sort_values = [doc_distance, doc.uid]
+                elif sort == ItemSort.START_DATE:
+                    sort_values = [long(doc.start_date * 1000), doc.uid]
+                else:
+                    sort_values = [doc.uid]
+                if search_after is None or sort_values > search_after:
+                    results.append((sort_values, doc))
+            page = heapq.nsmallest(start_offset + limit, results, key=lambda result: result[0])[start_offset:]
+            hits = [{'_id': doc.uid, '_source': doc.get_source(source), 'sort': sort_values}
+                    for sort_values, doc in page]
+        new_cursor = None
+        if hits and len(hits) == limit:
+            new_cursor = create_cursor(hits[-1]['sort'])
+        return new_cursor, hits
+
+    def search_clusters(self, lat, lon, distance, start, end, zoom, filter_type, bbox=None):
+        precision = get_cluster_precision(zoom)
+        tiles = {}
+        index = self._get_index()
+        with self._lock:
+            for doc, _ in index.find(lat, lon, distance, start, end, filter_type, bbox):
+                tile = _get_geotile(doc.lat, doc.lon, precision)
+                if tile not in tiles:
+                    tiles[tile] = [0, 0.0, 0.0, Counter()]
+                cluster = tiles[tile]
+                cluster[0] += 1
+                cluster[1] += doc.lat
+                cluster[2] += doc.lon
+                cluster[3][doc.source['icon']['id']] += 1
+        clusters = heapq.nsmallest(MAX_CLUSTERS, tiles.iteritems(), key=lambda item: (-item[1][0], item[0]))
+        # Same format as the buckets of a geotile_grid aggregation
+        return [{
+            'key': '%d/%d/%d' % (precision, x, y),
+            'doc_count': count,
+            'centroid': {
+                'location': {
+                    'lat': lat_sum / count,
+                    'lon': lon_sum / count
+                },
+                'count': count
+            },
+            'icons': {
+                'buckets': [{'key': icon_id, 'doc_count': icon_count}
+                            for icon_id, icon_count in _get_top_terms(icons, 1)]
+            }
+        } for (x, y), (count, lat_sum, lon_sum, icons) in clusters]
+
+    def execute_bulk_request(self, operations, raise_on_error=True):
+        # Doesn't load the index: the changes are saved in the datastore too, and will be in the index once it's loaded
+        operations = list(operations)
+        with self._lock:
+            if self._pending_operations is not None:
+                self._pending_operations.extend(operations)
+            return self._apply_operations(self._index, operations)
+
+    def _apply_operations(self, index, operations):
+        # type: (SpatioTemporalIndex, Iterable[Dict]) -> List[Dict]
+        # Without an index, every operation succeeds
+        items = []
+        operations = iter(operations)
+        for operation in operations:
+            if 'index' in operation:
+                uid = operation['index']['_id']
+                source = next(operations)
+                if index is not None:
+                    index.add(uid, source)
+                items.append({'index': {'_id': uid, 'status': 200, 'result': 'updated'}})
+            elif 'delete' in operation:
+                uid = operation['delete']['_id']
+                if index is None or index.remove(uid):
+                    items.append({'delete': {'_id': uid, 'status': 200, 'result': 'deleted'}})
+                else:
+                    items.append({'delete': {'_id': uid, 'status': 404, 'result': 'not_found'}})
+            else:
+                raise Exception('Unsupported bulk operation: %s' % operation.keys())
+        return items
+
+
+def _load_index_operations():
+    # type: () -> Iterable[Dict]
+    # Imported here since gipod.py depends on the search module
+    from plugins.gipod.bizz.gipod import get_map_item_index_operations
+    cursor = None
+    more = True
+    while more:
+        map_items, cursor, more = MapItem.query().fetch_page(LOAD_BATCH_SIZE, start_cursor=cursor)
+        for operation in get_map_item_index_operations(map_items):
+            yield operation
+
+
+def _get_timestamp(date_string):
+    # type: (unicode) -> float
+    if not date_string:
+        return None
+    d = parse_datetime(date_string)
+    if d.tzinfo:
+        d = d.astimezone(tzutc()).replace(tzinfo=None)
+    return get_epoch_from_datetime(d) + d.microsecond / 1e6
+
+
+def _get_cell(lat, lon):
+    # type: (float, float) -> Tuple[int, int]
+    return int(math.floor(lat / CELL_SIZE)), int(math.floor(lon / CELL_SIZE))
+
+
+def _get_distance(lat1, lon1, lat2, lon2):
+    # type: (float, float, float, float) -> float
+    # Haversine formula, in meters
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def _get_top_terms(counts, size):
+    # type: (Counter, int) -> List[Tuple[unicode, int]]
+    # Like a terms aggregation: the most common first, terms with the same count in alphabetical order
+    return heapq.nsmallest(size, counts.iteritems(), key=lambda term: (-term[1], term[0]))
+
+
+def _get_geotile(lat, lon, precision):
+    # type: (float, float, int) -> Tuple[int, int]
+    # Web mercator tile containing the location, like the geotile_grid aggregation of elasticsearch
+    tiles = 1 << precision
+    x = int((lon + 180) / 360 * tiles)
+    lat_rad = math.radians(max(min(lat, 85.05112878), -85.05112878))
+    y = int((1 - math.log(math.tan(lat_rad) + 1 / math.cos(lat_rad)) / math.pi) / 2 * tiles)
+    return min(max(x, 0), tiles - 1), min(max(y, 0), tiles - 1)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import base64
+import itertools
+import json
+
+from typing import Dict, Tuple, Iterable, List, Union
+
+from plugins.gipod.models import WorkAssignment, Manifestation, ItemFilterType, SearchBackendType
+from plugins.gipod.plugin_consts import SEARCH_BACKEND
+
+# Fields needed to create a MapItemTO from a search hit
+MAP_ITEM_SOURCE_FIELDS = ['location', 'title', 'icon', 'periods']
+MAX_CLUSTERS = 1000
+
+
+class SearchBackend(object):
+    # Documents are added and removed with elasticsearch bulk operations (see index_doc_operations), search results
+    # and cluster buckets are returned in the format elasticsearch uses so every backend can be used interchangeably.
+
+    def search_items(self, lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox=None, sort=None):
+        # type: (float, float, int, str, str, str, int, str, Union[bool, List[str]], Dict, str) -> Tuple[unicode, List]
+        # Returns the cursor for the next page and the hits, as dicts with the keys _id, _source and sort
+        raise NotImplementedError()
+
+    def search_clusters(self, lat, lon, distance, start, end, zoom, filter_type, bbox=None):
+        # type: (float, float, int, str, str, int, str, Dict) -> List[Dict]
+        raise NotImplementedError()
+
+    def execute_bulk_request(self, operations, raise_on_error=True):
+        # type: (Iterable[Dict], bool) -> List[Dict]
+        raise NotImplementedError()
+
+    def update_mapping(self):
+        # Makes sure the fields that are searched, sorted or aggregated on have the right type.
+        # Only needed for backends that store their index.
+        pass
+
+
+_backend = None
+
+
+def get_search_backend():
+    # type: () -> SearchBackend
+    global _backend
+    if _backend is None:
+        # Imported here since the backends depend on this module
+        if SEARCH_BACKEND == SearchBackendType.MEMORY:
+            from plugins.gipod.bizz.memory_search import MemorySearchBackend
+            _backend = MemorySearchBackend()
+        elif SEARCH_BACKEND == SearchBackendType.ELASTICSEARCH:
+            from plugins.gipod.bizz.elasticsearch import ElasticsearchBackend
+            _backend = ElasticsearchBackend()
+        else:
+            raise Exception('Unknown search backend: %s' % SEARCH_BACKEND)
+    return _backend
+
+
+def delete_doc_operations(uid):
+    yield {'delete': {'_id': uid}}
+
+
+def index_doc_operations(uid, doc):
+    yield {'index': {'_id': uid}}
+    yield doc
+
+
+def execute_bulk_request(operations, raise_on_error=True):
+    # type: (Iterable[Dict], bool) -> List[Dict]
+    return get_search_backend().execute_bulk_request(operations, raise_on_error)
+
+
+def get_bulk_errors(items):
+    # type: (List[Dict]) -> Dict[unicode, unicode]
+    # Maps the ids of the failed operations of a bulk request to the reason they failed
+    errors = {}
+    for item in items:
+        result = item.values()[0]
+        if 'error' in result:
+            errors[result['_id']] = result['error'].get('reason')
+    return errors
+
+
+def delete_docs(uids):
+    operations = itertools.chain.from_iterable([delete_doc_operations(uid) for uid in uids])
+    return execute_bulk_request(operations)
+
+
+def index_documents(docs):
+    # type: (List[Tuple[str, Dict]]) -> List[Dict]
+    operations = itertools.chain.from_iterable([index_doc_operations(uid, doc) for uid, doc in docs])
+    return execute_bulk_request(operations)
+
+
+def perform_search(lat, lon, distance, start, end, cursor=None, limit=10, filter_type=ItemFilterType.RANGE, bbox=None,
+                   sort=None):
+    new_cursor, hits = get_search_backend().search_items(lat, lon, distance, start, end, cursor, limit, filter_type,
+                                                         False, bbox, sort)
+    keys = get_model_keys_from_search_result_ids([hit['_id'] for hit in hits])
+    return keys, new_cursor
+
+
+def search_map_items(lat, lon, distance, start, end, cursor=None, limit=10, filter_type=ItemFilterType.RANGE,
+                     bbox=None, sort=None):
+    # type: (float, float, int, str, str, str, int, str, Dict, str) -> Tuple[List[Tuple[unicode, Dict]], unicode]
+    # Returns the ids and sources of the hits, in the order of the search
+    new_cursor, hits = get_search_backend().search_items(lat, lon, distance, start, end, cursor, limit, filter_type,
+                                                         MAP_ITEM_SOURCE_FIELDS, bbox, sort)
+    return [(hit['_id'], hit.get('_source') or {}) for hit in hits], new_cursor
+
+
+def search_clusters(lat, lon, distance, start, end, zoom, filter_type=ItemFilterType.RANGE, bbox=None):
+    # type: (float, float, int, str, str, int, str, Dict) -> List[Dict]
+    # Groups the matching items per map tile. Tiles are 4 times smaller than the tiles of the requested zoom level.
+    return get_search_backend().search_clusters(lat, lon, distance, start, end, zoom, filter_type, bbox)
+
+
+def get_model_keys_from_search_result_ids(ids):
+    keys = set()
+    for uid in ids:
+        key = get_model_key_from_search_result_id(uid)
+        if key:
+            keys.add(key)
+    return keys
+
+
+def get_model_key_from_search_result_id(uid):
+    parts = uid.split('-')
+
+    if len(parts) == 2:
+        type_, gipod_id = parts
+    else:
+        type_, gipod_id, _ = parts
+
+    if type_ == 'w':
+        return WorkAssignment.create_key(WorkAssignment.TYPE, gipod_id)
+    elif type_ == 'm':
+        return Manifestation.create_key(Manifestation.TYPE, gipod_id)
+    return None
+
+
+def get_cluster_precision(zoom):
+    # type: (int) -> int
+    # Precision of the geotile grid used to cluster items
+    return min(int(zoom) + 2, 29)
+
+
+def create_cursor(sort_values):
+    # type: (List) -> unicode
+    return base64.urlsafe_b64encode(json.dumps({'after': sort_values}, separators=(',', ':'))).decode('ascii')
+
+
+def parse_cursor(cursor):
+    # type: (unicode) -> Tuple[long, List]
+    if not cursor:
+        return 0, None
+    if cursor.isdigit():
+        return long(cursor), None
+    try:
+        return 0, json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))['after']
+    except (TypeError, ValueError, KeyError):
+        raise Exception('Invalid cursor: %s' % cursor)
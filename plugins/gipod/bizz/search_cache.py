@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from __future__ import unicode_literals
+
+import cPickle as pickle
+import hashlib
+import json
+import logging
+import math
+import time
+from datetime import datetime, timedelta
+
+from google.appengine.api import memcache
+from typing import Tuple, List, Iterable, Callable
+
+from plugins.gipod.bizz import search
+from plugins.gipod.models import ItemFilterType
+from plugins.gipod.plugin_consts import NAMESPACE
+from plugins.gipod.utils.cache import LRUCache
+from plugins.gipod.utils.timing import get_request_timer
+
+# Search queries are normalized so that requests for nearby locations share the same cache entry:
+# the center snaps to a grid, and the distance is rounded up to a bucket after adding the snap error.
+GRID_SIZE = 0.005  # degrees, ~550m
+DISTANCE_BUCKET = 500  # meters
+METERS_PER_DEGREE = 111320
+SNAP_MARGIN = int(math.ceil(GRID_SIZE / 2 * METERS_PER_DEGREE * math.sqrt(2)))
+
+# Every cell has a generation in memcache which changes when an item in it is updated or removed.
+# Cached results are stored under a key containing the generations of all cells their query covers.
+INVALIDATION_CELL_SIZE = 0.1  # degrees, ~11km
+MAX_INVALIDATION_CELLS = 25  # queries covering more cells aren't cached
+
+SEARCH_CACHE_TTL = 300  # seconds
+# Results are cached serialized, so their size is known. Results that don't fit in memcache aren't cached at all.
+MAX_LOCAL_BYTES = 16 * 1024 * 1024
+_search_cache = LRUCache(max_size=500, ttl=SEARCH_CACHE_TTL, max_bytes=MAX_LOCAL_BYTES)
+
+
+def search_map_items(lat, lon, distance, start, end, cursor=None, limit=10, filter_type=ItemFilterType.RANGE,
+                     bbox=None, sort=None):
+    # type: (float, float, int, str, str, str, int, str, dict, str) -> Tuple[List[Tuple[unicode, dict]], unicode]
+    return _cached_search('items', search.search_map_items, lat, lon, distance, start, end, cursor, limit,
+                          filter_type, bbox, sort)
+
+
+def perform_search(lat, lon, distance, start, end, cursor=None, limit=10, filter_type=ItemFilterType.RANGE,
+                   bbox=None, sort=None):
+    # type: (float, float, int, str, str, str, int, str, dict, str) -> Tuple[List[ndb.Key], unicode]
+    return _cached_search('keys', search.perform_search, lat, lon, distance, start, end, cursor, limit,
+                          filter_type, bbox, sort)
+
+
+def invalidate_search_cache(coordinates):
+    # type: (Iterable[Tuple[float, float]]) -> None
+    cell_keys = {_get_cell_key(*_get_cell(lat, lon)) for lat, lon in coordinates}
+    if cell_keys:
+        # Missing generations don't need to be incremented, they will get a new value when they are read
+        memcache.offset_multi({key: 1 for key in cell_keys}, namespace=NAMESPACE)
+
+
+def _cached_search(mode, search_func, lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort):
+    # type: (str, Callable, float, float, int, str, str, str, int, str, dict, str) -> tuple
+    lat, lon, distance, start, end, bbox = _normalize_query(lat, lon, distance, start, end, filter_type, bbox)
+    if bbox:
+        cell_keys = _get_bbox_cell_keys(bbox['north'], bbox['east'], bbox['south'], bbox['west'])
+    else:
+        cell_keys = _get_cell_keys(lat, lon, distance)
+    if not cell_keys:
+        return search_func(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort)
+
+    generations = _get_generations(cell_keys)
+    key_data = [mode, lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort, generations]
+    cache_key = 'search-result-%s' % hashlib.sha1(json.dumps(key_data, sort_keys=True)).hexdigest()
+    serialized = _search_cache.get(cache_key)
+    if serialized is None:
+        serialized = memcache.get(cache_key, namespace=NAMESPACE)
+        if serialized is None:
+            result = search_func(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort)
+            result = list(result[0]), result[1]
+            serialized = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+            if len(serialized) > memcache.MAX_VALUE_SIZE:
+                # e.g. a page of 1000 items with a lot of periods
+                logging.debug('Not caching search result %s of %d bytes', cache_key, len(serialized))
+                return result
+            memcache.set(cache_key, serialized, time=SEARCH_CACHE_TTL, namespace=NAMESPACE)
+            _search_cache.set(cache_key, serialized)
+            return result
+        _search_cache.set(cache_key, serialized)
+    get_request_timer().count('search_cache_hits')
+    return pickle.loads(serialized)
+
+
+def _normalize_query(lat, lon, distance, start, end, filter_type, bbox):
+    if lat is not None and lon is not None:
+        lat = _snap(lat)
+        lon = _snap(lon)
+    if distance:
+        distance = int(math.ceil(float(distance + SNAP_MARGIN) / DISTANCE_BUCKET)) * DISTANCE_BUCKET
+    if bbox:
+        # Only grow the bounding box, so it still contains the whole viewport
+        bbox = {
+            'north': _snap(bbox['north'], math.ceil),
+            'east': _snap(bbox['east'], math.ceil),
+            'south': _snap(bbox['south'], math.floor),
+            'west': _snap(bbox['west'], math.floor),
+        }
+    start = _round_date(start, False)
+    if end or filter_type == ItemFilterType.START_DATE:
+        end = _round_date(end, True)
+    return lat, lon, distance, start, end, bbox
+
+
+def _snap(value, rounding=round):
+    # type: (float, Callable) -> float
+    return round(rounding(value / GRID_SIZE) * GRID_SIZE, 6)
+
+
+def _round_date(date_str, up):
+    # type: (unicode, bool) -> unicode
+    if not date_str:
+        return date_str
+    day = datetime.strptime(date_str[:10], '%Y-%m-%d')
+    if up:
+        day += timedelta(days=1)
+    return day.strftime('%Y-%m-%d')
+
+
+def _get_cell(lat, lon):
+    # type: (float, float) -> Tuple[int, int]
+    return int(math.floor(lat / INVALIDATION_CELL_SIZE)), int(math.floor(lon / INVALIDATION_CELL_SIZE))
+
+
+def _get_cell_key(cell_lat, cell_lon):
+    return 'search-cell-%d-%d' % (cell_lat, cell_lon)
+
+
+def _get_cell_keys(lat, lon, distance):
+    # type: (float, float, int) -> List[str]
+    lat_delta = float(distance) / METERS_PER_DEGREE
+    lon_delta = float(distance) / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return _get_bbox_cell_keys(lat + lat_delta, lon + lon_delta, lat - lat_delta, lon - lon_delta)
+
+
+def _get_bbox_cell_keys(north, east, south, west):
+    # type: (float, float, float, float) -> List[str]
+    min_lat, min_lon = _get_cell(south, west)
+    max_lat, max_lon = _get_cell(north, east)
+    if (max_lat - min_lat + 1) * (max_lon - min_lon + 1) > MAX_INVALIDATION_CELLS:
+        return []
+    return [_get_cell_key(cell_lat, cell_lon)
+            for cell_lat in xrange(min_lat, max_lat + 1)
+            for cell_lon in xrange(min_lon, max_lon + 1)]
+
+
+def _get_generations(cell_keys):
+    # type: (List[str]) -> List[long]
+    generations = memcache.get_multi(cell_keys, namespace=NAMESPACE)
+    missing = [key for key in cell_keys if key not in generations]
+    if missing:
+        # Use the current time as initial value, so a generation that was evicted never matches an old entry
+        initial_value = long(time.time() * 1000)
+        new_generations = {key: initial_value for key in missing}
+        not_added = memcache.add_multi(new_generations, namespace=NAMESPACE)
+        if not_added:
+            logging.debug('Generations were added concurrently: %s', not_added)
+            generations.update(memcache.get_multi(not_added, namespace=NAMESPACE))
+        generations.update({key: value for key, value in new_generations.iteritems() if key not in generations})
+    return [generations.get(key) for key in cell_keys]
@@ -22,7 +22,7 @@ from framework.utils.plugins import Handler
 from mcfw.consts import DEBUG
 from mcfw.rpc import parse_complex_value
 from plugins.gipod.handlers import GipodItemsHandler, GipodItemIdsHandler, \
-    GipodItemDetailsHandler, GipodMapHandler
+    GipodItemDetailsHandler, GipodMapHandler, GipodItemClustersHandler, GipodItemsDeltaHandler
 from plugins.gipod.handlers.cron import GipodCleanupTimedOutHandler, GipodCleanupDeletedHandler, \
     GipodSyncHandler
 from plugins.gipod.to import GipodPluginConfiguration
@@ -40,6 +40,8 @@ class GipodPlugin(Plugin):
             yield Handler(url='/plugins/gipod/items', handler=GipodItemsHandler)
             yield Handler(url='/plugins/gipod/items/ids', handler=GipodItemIdsHandler)
             yield Handler(url='/plugins/gipod/items/detail', handler=GipodItemDetailsHandler)
+            yield Handler(url='/plugins/gipod/items/clusters', handler=GipodItemClustersHandler)
+            yield Handler(url='/plugins/gipod/items/delta', handler=GipodItemsDeltaHandler)
         if auth == Handler.AUTH_ADMIN:
             yield Handler(url='/admin/cron/gipod/cleanup/timed_out', handler=GipodCleanupTimedOutHandler)
             yield Handler(url='/admin/cron/gipod/cleanup/deleted', handler=GipodCleanupDeletedHandler)
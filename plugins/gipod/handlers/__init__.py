@@ -15,55 +15,92 @@
 #
 # @@license_version:1.5@@
 
+import itertools
 import json
 import logging
 from datetime import datetime
 
 import webapp2
 from google.appengine.ext import ndb
+from typing import Iterable, List, Tuple, Union, Callable
 
+from framework.to import TO
 from framework.utils import try_or_defer
-from plugins.gipod.bizz import convert_to_item_tos, convert_to_item_details_tos, \
-    save_last_load_map_request
-from plugins.gipod.bizz.elasticsearch import perform_search, get_model_keys_from_search_result_ids
-from plugins.gipod.models import Consumer, ItemFilterType
-from plugins.gipod.to import GetMapItemDetailsResponseTO, GetMapItemsResponseTO
+from plugins.gipod.bizz import convert_to_item_details_tos, save_last_load_map_request, \
+    convert_search_hits_to_item_tos, convert_cluster_buckets_to_tos, get_item_details_versions, get_details_etag
+from plugins.gipod.bizz.consumer import is_valid_consumer
+from plugins.gipod.bizz.delta import get_items_delta
+from plugins.gipod.bizz.details_cache import get_cached_item_details, cache_item_details
+from plugins.gipod.bizz.search import get_model_keys_from_search_result_ids, search_clusters
+from plugins.gipod.bizz.search_cache import perform_search, search_map_items
+from plugins.gipod.models import ItemFilterType, ItemSort
+from plugins.gipod.to import GeometryFormat, MapItemTO, MapItemDetailsTO, MapClusterTO, GetMapClustersResponseTO
+from plugins.gipod.utils.geometry import get_tolerance_for_zoom
+from plugins.gipod.utils.timing import start_request_timer, stop_request_timer, get_request_timer
 
 
-def _get_item_ids(lat, lon, distance, start, end, cursor, limit, filter_type):
-    # type: (float, float, int, str, str, str, int, str) -> tuple[list[int], str]
-    keys, new_cursor = perform_search(lat, lon, distance, start, end, cursor, limit, filter_type)
+def _get_item_ids(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort):
+    # type: (float, float, int, str, str, str, int, str, dict, str) -> tuple[list[int], str]
+    timer = get_request_timer()
+    with timer.phase('search'):
+        keys, new_cursor = perform_search(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort)
+    timer.count('hits', len(keys))
     ids = [key.id() for key in keys]
     return ids, new_cursor
 
 
-def _get_items(lat, lon, distance, start, end, cursor, limit, filter_type):
-    keys, new_cursor = perform_search(lat, lon, distance, start, end, cursor, limit, filter_type)
-    # This can take a while, because some models can have large amounts of location data
-    models = ndb.get_multi(keys)
-    items = convert_to_item_tos(m for m in models if m)
-    return GetMapItemsResponseTO(items=items, cursor=new_cursor, distance=distance)
+def _get_items(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort):
+    # type: (float, float, int, str, str, str, int, str, dict, str) -> Tuple[Iterable[MapItemTO], unicode, int]
+    timer = get_request_timer()
+    with timer.phase('search'):
+        hits, new_cursor = search_map_items(lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort)
+    timer.count('hits', len(hits))
+    with timer.phase('datastore'):
+        items = convert_search_hits_to_item_tos(hits)
+    return items, new_cursor, distance
 
 
-def _get_details(ids):
-    keys = get_model_keys_from_search_result_ids(ids)
-    models = ndb.get_multi(keys)
-    return convert_to_item_details_tos([key.id() for key in keys], models)
+def _get_clusters(lat, lon, distance, start, end, zoom, filter_type, bbox):
+    # type: (float, float, int, str, str, int, str, dict) -> List[MapClusterTO]
+    timer = get_request_timer()
+    with timer.phase('search'):
+        buckets = search_clusters(lat, lon, distance, start, end, zoom, filter_type, bbox)
+    timer.count('hits', len(buckets))
+    with timer.phase('convert'):
+        return convert_cluster_buckets_to_tos(buckets)
+
+
+def _get_details(keys, tolerance=None, geometry_format=GeometryFormat.COORDINATES):
+    # type: (List[ndb.Key], float, str) -> Iterable[MapItemDetailsTO]
+    timer = get_request_timer()
+    with timer.phase('datastore'):
+        models = ndb.get_multi(keys)
+    timer.count('models', len([model for model in models if model]))
+    return convert_to_item_details_tos([key.id() for key in keys], models, tolerance, geometry_format)
 
 
 class AuthValidationHandler(webapp2.RequestHandler):
 
     def dispatch(self):
-        consumer_key = self.request.headers.get('consumer_key', None)
-        if not consumer_key:
-            self.abort(401)
-            return
-        c = Consumer.create_key(consumer_key).get()
-        if not c:
-            self.abort(401)
-            return
+        timer = start_request_timer()
+        try:
+            consumer_key = self.request.headers.get('consumer_key', None)
+            if not consumer_key:
+                self.abort(401)
+                return
+            with timer.phase('auth'):
+                is_valid = is_valid_consumer(consumer_key)
+            if not is_valid:
+                self.abort(401)
+                return
 
-        return super(AuthValidationHandler, self).dispatch()
+            return super(AuthValidationHandler, self).dispatch()
+        finally:
+            if timer.enabled:
+                timer.count('response_bytes', len(self.response.body))
+                self.response.headers['Server-Timing'] = timer.get_server_timing_header()
+                timer.log(self.request.path)
+            stop_request_timer()
 
 
 class GipodMapHandler(AuthValidationHandler):
@@ -81,14 +118,15 @@ class GipodItemsHandler(AuthValidationHandler):
     def post(self):
         logging.debug(self.request.body)
         params = json.loads(self.request.body) if self.request.body else {}
+        self.response.headers = {'Content-Type': 'application/json'}
         try:
-            result = _get_items(*_parse_params(params))
+            items, new_cursor, distance = _get_items(*_parse_params(params))
+            count = _write_items_response(self.response.out, items, new_cursor, distance)
         except Exception as e:
             logging.exception('Could not fetch items: %s', e.message)
-            result = GetMapItemsResponseTO(items=[], new_cursor=None, distance=0)
-        self.response.headers = {'Content-Type': 'application/json'}
-        logging.debug('got %s search results', len(result.items))
-        json.dump(result.to_dict(), self.response.out)
+            self.response.clear()
+            count = _write_items_response(self.response.out, [], None, 0)
+        logging.debug('got %s search results', count)
 
 
 class GipodItemIdsHandler(AuthValidationHandler):
@@ -104,7 +142,42 @@ class GipodItemIdsHandler(AuthValidationHandler):
             new_cursor = None
         logging.debug('got %s search results', len(ids))
         self.response.headers = {'Content-Type': 'application/json'}
-        json.dump({'ids': ids, 'cursor': new_cursor}, self.response.out)
+        with get_request_timer().phase('serialize'):
+            json.dump({'ids': ids, 'cursor': new_cursor}, self.response.out)
+
+
+class GipodItemsDeltaHandler(AuthValidationHandler):
+
+    def post(self):
+        logging.debug(self.request.body)
+        params = json.loads(self.request.body) if self.request.body else {}
+        try:
+            delta = get_items_delta(*_parse_delta_params(params))
+        except Exception as e:
+            logging.exception('Could not fetch the item delta: %s', e.message)
+            # Nothing changed according to the client, it can try again with the same token
+            delta = {'token': params.get('token'), 'added': [], 'removed': [], 'changed': [], 'reset': False,
+                     'truncated': False}
+        get_request_timer().count('hits', len(delta['added']) + len(delta['changed']))
+        self.response.headers = {'Content-Type': 'application/json'}
+        with get_request_timer().phase('serialize'):
+            json.dump(delta, self.response.out)
+
+
+class GipodItemClustersHandler(AuthValidationHandler):
+
+    def post(self):
+        logging.debug(self.request.body)
+        params = json.loads(self.request.body) if self.request.body else {}
+        try:
+            clusters = _get_clusters(*_parse_cluster_params(params))
+        except Exception as e:
+            logging.exception('Could not fetch clusters: %s', e.message)
+            clusters = []
+        logging.debug('got %s clusters', len(clusters))
+        self.response.headers = {'Content-Type': 'application/json'}
+        with get_request_timer().phase('serialize'):
+            json.dump(GetMapClustersResponseTO(clusters=clusters).to_dict(), self.response.out)
 
 
 class GipodItemDetailsHandler(AuthValidationHandler):
@@ -112,30 +185,175 @@ class GipodItemDetailsHandler(AuthValidationHandler):
     def post(self):
         logging.debug(self.request.body)
         params = json.loads(self.request.body) if self.request.body else {}
-        ids = params.get('ids', [])
-        result = GetMapItemDetailsResponseTO(items=_get_details(ids))
-        logging.debug('got %s results', len(result.items))
+        geometry_format = params.get('geometry_format') or self.request.headers.get('X-Geometry-Format') \
+            or GeometryFormat.COORDINATES
+        if geometry_format not in (GeometryFormat.COORDINATES, GeometryFormat.ENCODED_POLYLINE):
+            self.abort(400)
+            return
+        tolerance = _parse_tolerance(params)
+        # Versions of the items the client already has, only the items that changed are sent again
+        known_versions = params.get('versions') or {}
+        keys = sorted(get_model_keys_from_search_result_ids(params.get('ids', [])), key=lambda k: k.id())
+        current_date = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+        with get_request_timer().phase('versions'):
+            versions = get_item_details_versions(keys, current_date, tolerance, geometry_format)
+        changed_keys = []
+        unchanged_ids = []
+        for key in keys:
+            version = versions[key.id()]
+            if version and known_versions.get(key.id()) == version:
+                unchanged_ids.append(key.id())
+            else:
+                changed_keys.append(key)
+        etag = get_details_etag(versions, unchanged_ids)
         self.response.headers = {'Content-Type': 'application/json'}
-        json.dump(result.to_dict(), self.response.out)
+        if etag:
+            self.response.headers['ETag'] = '"%s"' % etag
+            if etag in self.request.if_none_match:
+                self.response.status = 304
+                return
+        # Details that were rendered before are served from the cache, without loading the items
+        with get_request_timer().phase('cache'):
+            cached = get_cached_item_details({key.id(): versions[key.id()] for key in changed_keys
+                                              if versions[key.id()]})
+        get_request_timer().count('cached_details', len(cached))
+        keys_to_render = [key for key in changed_keys if key.id() not in cached]
+        items = itertools.chain(cached.itervalues(),
+                                _set_versions(_get_details(keys_to_render, tolerance, geometry_format), versions))
+        rendered = {}
+
+        def on_serialized(item, serialized):
+            if item.version:
+                rendered[item.id] = (item.version, serialized)
+
+        # Same layout as GetMapItemDetailsResponseTO
+        count = _write_json_response(self.response.out, {'2': unchanged_ids}, '1', items, on_serialized)
+        cache_item_details(rendered)
+        logging.debug('got %s results, %s unchanged, %s cached', count, len(unchanged_ids), len(cached))
+
+
+def _set_versions(items, versions):
+    # type: (Iterable[MapItemDetailsTO], dict) -> Iterable[MapItemDetailsTO]
+    for item in items:
+        item.version = versions.get(item.id)
+        yield item
+
+
+def _write_items_response(out, items, cursor, distance):
+    # type: (file, Iterable[MapItemTO], unicode, int) -> int
+    # Same layout as GetMapItemsResponseTO
+    fields = {
+        '1': cursor,
+        '3': distance,
+    }
+    return _write_json_response(out, fields, '2', items)
+
+
+def _write_json_response(out, fields, items_field, items, on_serialized=None):
+    # type: (file, dict, str, Iterable[Union[TO, str]], Callable[[TO, str], None]) -> int
+    # Writes the items one by one as they are converted, instead of serializing the whole response at once.
+    # Items that are strings were serialized before (e.g. cached), on_serialized is called for the other items.
+    timer = get_request_timer()
+    out.write('{')
+    for name in sorted(fields):
+        out.write('%s:%s,' % (json.dumps(name), json.dumps(fields[name])))
+    out.write('%s:[' % json.dumps(items_field))
+    count = 0
+    for item in timer.timed_iter('convert', items):
+        with timer.phase('serialize'):
+            if count:
+                out.write(',')
+            if isinstance(item, basestring):
+                out.write(item)
+            else:
+                serialized = json.dumps(item.to_dict(), sort_keys=True, separators=(',', ':'))
+                out.write(serialized)
+                if on_serialized:
+                    on_serialized(item, serialized)
+        count += 1
+    out.write(']}')
+    return count
 
 
 def _parse_params(params):
-    lat = params.get('lat')
-    lon = params.get('lon')
-    distance = params.get('distance')
+    lat, lon, distance, bbox = _parse_location_params(params)
     start = params.get('start')
     end = params.get('end', None)
     limit = params.get('limit')
     cursor = params.get('cursor', None)
     filter_type = params.get('filter_type', ItemFilterType.RANGE)
+    sort = params.get('sort', None)
 
-    if lat and lon and distance and start and limit and filter_type:
-        lat = float(lat)
-        lon = float(lon)
-        distance = long(distance)
+    if start and limit and filter_type:
         limit = long(limit)
         if limit > 1000:
             limit = 1000
     else:
         raise Exception('Not all parameters were provided')
-    return lat, lon, distance, start, end, cursor, limit, filter_type
+    if sort == ItemSort.DISTANCE and lat is None:
+        raise Exception('lat and lon are required to sort on distance')
+    return lat, lon, distance, start, end, cursor, limit, filter_type, bbox, sort
+
+
+def _parse_cluster_params(params):
+    lat, lon, distance, bbox = _parse_location_params(params)
+    start = params.get('start')
+    end = params.get('end', None)
+    zoom = params.get('zoom')
+    filter_type = params.get('filter_type', ItemFilterType.RANGE)
+
+    if start and zoom is not None and filter_type:
+        zoom = int(zoom)
+    else:
+        raise Exception('Not all parameters were provided')
+    return lat, lon, distance, start, end, zoom, filter_type, bbox
+
+
+def _parse_delta_params(params):
+    # Either the token of the previous delta, or the ids the client knows and the `time` of the delta they came from
+    lat, lon, distance, bbox = _parse_location_params(params)
+    start = params.get('start')
+    end = params.get('end', None)
+    filter_type = params.get('filter_type', ItemFilterType.RANGE)
+    token = params.get('token')
+    known_ids = params.get('ids')
+    since = params.get('since')
+
+    if not start or not filter_type:
+        raise Exception('Not all parameters were provided')
+    if known_ids is not None and since is None:
+        raise Exception('since is required when ids are provided')
+    since = long(since) if since is not None else None
+    return lat, lon, distance, start, end, filter_type, bbox, token, known_ids, since
+
+
+def _parse_location_params(params):
+    # Either a bounding box ({north, east, south, west}), or a circle around lat, lon
+    lat = params.get('lat')
+    lon = params.get('lon')
+    distance = params.get('distance')
+    bbox = params.get('bbox')
+    if lat and lon:
+        lat = float(lat)
+        lon = float(lon)
+    else:
+        lat = lon = None
+    if bbox:
+        bbox = {side: float(bbox[side]) for side in ('north', 'east', 'south', 'west')}
+        distance = long(distance) if distance else None
+    elif lat is not None and distance:
+        distance = long(distance)
+    else:
+        raise Exception('Not all parameters were provided')
+    return lat, lon, distance, bbox
+
+
+def _parse_tolerance(params):
+    # type: (dict) -> float
+    tolerance = params.get('tolerance')
+    if tolerance is not None:
+        return float(tolerance)
+    zoom = params.get('zoom')
+    if zoom is not None:
+        return get_tolerance_for_zoom(float(zoom))
+    return None
@@ -27,10 +27,32 @@ class ItemFilterType(object):
     START_DATE = 'start_date'
 
 
+class ItemSort(object):
+    DISTANCE = 'distance'
+    START_DATE = 'start_date'
+    NONE = 'none'  # only sorted on id
+
+
+class SearchBackendType(object):
+    ELASTICSEARCH = 'elasticsearch'
+    # In-process index, for development and small deployments without an elasticsearch cluster
+    MEMORY = 'memory'
+
+
+class SyncMode(object):
+    # One task per batch of items
+    TASKS = 'tasks'
+    # Every page of the list result updates its items itself, fetching their details concurrently
+    PAGE = 'page'
+
+
 class SyncSettings(NdbModel):  # for both work assignments and manifestations
     NAMESPACE = NAMESPACE
 
     synced_until = ndb.DateTimeProperty()
+    mode = ndb.StringProperty(indexed=False, choices=(SyncMode.TASKS, SyncMode.PAGE))
+    # Max amount of concurrent requests to the gipod api per task
+    fetch_concurrency = ndb.IntegerProperty(indexed=False)
 
     @classmethod
     def create_key(cls):
@@ -44,12 +66,30 @@ class BaseModel(NdbModel):
 
     cleanup_date = ndb.DateTimeProperty()
 
-    data = ndb.JsonProperty(indexed=False)
+    # Detail document from gipod, without the geometries (see packed_geometries). Entities saved before it was
+    # compressed can still be read, they are compressed the next time they are saved (e.g. by re_index_all).
+    # ndb only decompresses and parses it when it is accessed.
+    data = ndb.JsonProperty(indexed=False, compressed=True)
+    # Hash of the cleaned data, used to detect if anything changed on gipod
+    data_hash = ndb.StringProperty(indexed=False)
+    # When the data last changed, see bizz.delta
+    modified = ndb.DateTimeProperty(indexed=False)
+    # Simplified copies of the location and diversion geometries, from fine to coarse
+    geometry_levels = ndb.JsonProperty(indexed=False, compressed=True)
+    # Full resolution location and diversion geometries, see utils.packed_geometry. They are removed from data.
+    packed_geometries = ndb.BlobProperty(indexed=False)
+    # Periods parsed from data, sorted by start date
+    start_dates = ndb.DateTimeProperty(repeated=True, indexed=False)
+    end_dates = ndb.DateTimeProperty(repeated=True, indexed=False)
 
     @property
     def uid(self):
         return self.key.id()
 
+    @property
+    def periods(self):
+        return zip(self.start_dates, self.end_dates)
+
     @property
     def gipod_id(self):
         return self.uid.split('-')[1]
@@ -81,6 +121,35 @@ class Manifestation(BaseModel):
     TYPE = BaseModel.TYPE_MANIFESTATION
 
 
+class MapItem(NdbModel):
+    # Compact projection of a WorkAssignment or Manifestation, containing only what's needed to render the item list
+    NAMESPACE = NAMESPACE
+
+    lat = ndb.FloatProperty(indexed=False)
+    lon = ndb.FloatProperty(indexed=False)
+    icon_id = ndb.StringProperty(indexed=False)
+    icon_color = ndb.StringProperty(indexed=False)
+    title = ndb.TextProperty()
+    # data_hash of the item, so its version is known without loading it
+    data_hash = ndb.StringProperty(indexed=False)
+    modified = ndb.DateTimeProperty(indexed=False)
+    # Sorted by start date
+    start_dates = ndb.DateTimeProperty(repeated=True, indexed=False)
+    end_dates = ndb.DateTimeProperty(repeated=True, indexed=False)
+
+    @property
+    def uid(self):
+        return self.key.id()
+
+    @property
+    def periods(self):
+        return zip(self.start_dates, self.end_dates)
+
+    @classmethod
+    def create_key(cls, uid):
+        return ndb.Key(cls, uid, namespace=cls.NAMESPACE)
+
+
 class Consumer(NdbModel):
     NAMESPACE = NAMESPACE
 
@@ -94,6 +163,16 @@ class Consumer(NdbModel):
     def create_key(cls, consumer_key):
         return ndb.Key(cls, consumer_key, namespace=cls.NAMESPACE)
 
+    def _post_put_hook(self, future):
+        # Imported here since the consumer module depends on the models
+        from plugins.gipod.bizz.consumer import invalidate_consumer
+        invalidate_consumer(self.consumer_key)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        from plugins.gipod.bizz.consumer import invalidate_consumer
+        invalidate_consumer(key.id().decode('utf8'))
+
 
 class ElasticsearchSettings(NdbModel):
     NAMESPACE = NAMESPACE
@@ -108,6 +187,16 @@ class ElasticsearchSettings(NdbModel):
     def create_key(cls):
         return ndb.Key(cls, u'ElasticsearchSettings', namespace=cls.NAMESPACE)
 
+    def _post_put_hook(self, future):
+        # Imported here since the elasticsearch module depends on the models
+        from plugins.gipod.bizz.elasticsearch import invalidate_elasticsearch_config
+        invalidate_elasticsearch_config()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        from plugins.gipod.bizz.elasticsearch import invalidate_elasticsearch_config
+        invalidate_elasticsearch_config()
+
 
 class MapUser(NdbModel):
     NAMESPACE = NAMESPACE
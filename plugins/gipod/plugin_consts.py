@@ -17,8 +17,20 @@
 
 from __future__ import unicode_literals
 
+import os
+
 NAMESPACE = 'gipod'
 
 SYNC_QUEUE = 'sync-queue'
+# Amount of items that are fetched, saved and indexed together by one sync task
+SYNC_BATCH_SIZE = 50
+# Max amount of concurrent requests to the gipod api per sync task
+SYNC_FETCH_CONCURRENCY = 10
+
+# See SearchBackendType
+SEARCH_BACKEND = os.environ.get('GIPOD_SEARCH_BACKEND', 'elasticsearch')
+
+# Fraction of the api requests for which the duration of every phase is logged and returned in a Server-Timing header
+TIMING_SAMPLE_RATE = float(os.environ.get('GIPOD_TIMING_SAMPLE_RATE', '0.01'))
 
 GIPOD_API_URL = 'https://api.gipod.vlaanderen.be/ws/v1'
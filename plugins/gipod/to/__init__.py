@@ -16,7 +16,8 @@
 # @@license_version:1.5@@
 
 from framework.to import TO
-from mcfw.properties import unicode_property, float_property, typed_property, long_property, object_factory
+from mcfw.properties import unicode_property, float_property, typed_property, long_property, object_factory, \
+    unicode_list_property
 
 
 class GipodPluginConfiguration(TO):
@@ -34,6 +35,16 @@ class MapGeometryType(object):
     MULTI_LINE_STRING = 'MultiLineString'
     POLYGON = 'Polygon'
     MULTI_POLYGON = 'MultiPolygon'
+    # Same geometries, but with every list of coordinates as an encoded polyline
+    ENCODED_LINE_STRING = 'EncodedLineString'
+    ENCODED_MULTI_LINE_STRING = 'EncodedMultiLineString'
+    ENCODED_POLYGON = 'EncodedPolygon'
+    ENCODED_MULTI_POLYGON = 'EncodedMultiPolygon'
+
+
+class GeometryFormat(object):
+    COORDINATES = 'coordinates'
+    ENCODED_POLYLINE = 'polyline'
 
 
 class CoordsListTO(TO):
@@ -67,11 +78,42 @@ class MultiPolygonGeometryTO(TO):
     polygons = typed_property('polygons', PolygonTO, True)
 
 
+class EncodedPolygonTO(TO):
+    rings = unicode_list_property('rings')
+
+
+class EncodedLineStringGeometryTO(TO):
+    type = unicode_property('type', default=MapGeometryType.ENCODED_LINE_STRING)
+    color = unicode_property('color')
+    line = unicode_property('line')
+
+
+class EncodedMultiLineStringGeometryTO(TO):
+    type = unicode_property('type', default=MapGeometryType.ENCODED_MULTI_LINE_STRING)
+    color = unicode_property('color')
+    lines = unicode_list_property('lines')
+
+
+class EncodedPolygonGeometryTO(EncodedPolygonTO):
+    type = unicode_property('type', default=MapGeometryType.ENCODED_POLYGON)
+    color = unicode_property('color')
+
+
+class EncodedMultiPolygonGeometryTO(TO):
+    type = unicode_property('type', default=MapGeometryType.ENCODED_MULTI_POLYGON)
+    color = unicode_property('color')
+    polygons = typed_property('polygons', EncodedPolygonTO, True)
+
+
 MAP_GEOMETRY_MAPPING = {
     MapGeometryType.LINE_STRING: LineStringGeometryTO,
     MapGeometryType.MULTI_LINE_STRING: MultiLineStringGeometryTO,
     MapGeometryType.POLYGON: PolygonGeometryTO,
     MapGeometryType.MULTI_POLYGON: MultiPolygonGeometryTO,
+    MapGeometryType.ENCODED_LINE_STRING: EncodedLineStringGeometryTO,
+    MapGeometryType.ENCODED_MULTI_LINE_STRING: EncodedMultiLineStringGeometryTO,
+    MapGeometryType.ENCODED_POLYGON: EncodedPolygonGeometryTO,
+    MapGeometryType.ENCODED_MULTI_POLYGON: EncodedMultiPolygonGeometryTO,
 }
 
 
@@ -131,6 +173,7 @@ class MapItemDetailsTO(TO):
     id = unicode_property('id')
     geometry = typed_property('geometry', MapGeometryTO(), True)
     sections = typed_property('sections', MapSectionTO(), True)
+    version = unicode_property('version')
 
 
 class GetMapItemsResponseTO(TO):
@@ -139,5 +182,17 @@ class GetMapItemsResponseTO(TO):
     distance = long_property('3')
 
 
+class MapClusterTO(TO):
+    coords = typed_property('1', GeoPointTO, False)
+    count = long_property('2')
+    icon = typed_property('3', MapIconTO, False)  # icon of the most common item type
+
+
+class GetMapClustersResponseTO(TO):
+    clusters = typed_property('1', MapClusterTO, True)
+
+
 class GetMapItemDetailsResponseTO(TO):
     items = typed_property('1', MapItemDetailsTO, True)
+    # Ids of the requested items of which the client already has the current version
+    unchanged = unicode_list_property('2')
@@ -15,6 +15,11 @@
 #
 # @@license_version:1.5@@
 
+import calendar
+from datetime import datetime
+
+from dateutil.parser import parse as parse_datetime_fallback
+
 from framework.utils import azzert
 from mcfw.rpc import returns, arguments
 
@@ -35,3 +40,22 @@ def get_app_user_tuple_by_email(app_user_email):
 @arguments(user_id=unicode)
 def get_app_id_from_user_id(user_id):
     return get_app_user_tuple_by_email(user_id)[1]
+
+
+def get_epoch_from_datetime(d):
+    # type: (datetime) -> long
+    return calendar.timegm(d.utctimetuple())
+
+
+def get_datetime_from_epoch(epoch):
+    # type: (long) -> datetime
+    return datetime.utcfromtimestamp(epoch)
+
+
+def parse_datetime(value):
+    # type: (unicode) -> datetime
+    # Dates from gipod are always in this format. strptime is a lot faster than the dateutil parser.
+    try:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return parse_datetime_fallback(value)
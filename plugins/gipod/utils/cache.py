@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Callable
+
+
+class LRUCache(object):
+    # Thread safe in-memory cache that drops the least recently used entries once max_size is reached, or once the
+    # total size of the values exceeds max_bytes. get_size returns the size of a value in bytes.
+
+    def __init__(self, max_size, ttl, max_bytes=None, get_size=len):
+        # type: (int, int, int, Callable[[object], int]) -> None
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self.size_in_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expiration, _ = entry
+            if expiration < time.time():
+                self._pop(key)
+                return default
+            # Mark as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expiration = time.time() + (self.ttl if ttl is None else ttl)
+        size = self.get_size(value) if self.max_bytes else 0
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes and size > self.max_bytes:
+                return
+            self._entries[key] = (value, expiration, size)
+            self.size_in_bytes += size
+            while len(self._entries) > self.max_size or (self.max_bytes and self.size_in_bytes > self.max_bytes):
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_in_bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size_in_bytes -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from typing import List
+
+
+def get_tolerance_for_zoom(zoom):
+    # type: (float) -> float
+    # Size of one pixel in degrees at this zoom level (256px tiles)
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def encode_polyline(coordinates, precision=5):
+    # type: (List[List[float]], int) -> unicode
+    # Google's encoded polyline algorithm, coordinates are [lon, lat] pairs
+    factor = 10 ** precision
+    result = []
+    previous_lat = previous_lon = 0
+    for coordinate in coordinates:
+        lat = int(round(coordinate[1] * factor))
+        lon = int(round(coordinate[0] * factor))
+        _encode_polyline_value(lat - previous_lat, result)
+        _encode_polyline_value(lon - previous_lon, result)
+        previous_lat, previous_lon = lat, lon
+    return u''.join(result)
+
+
+def _encode_polyline_value(value, result):
+    # type: (int, List[str]) -> None
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        result.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    result.append(chr(value + 63))
+
+
+def simplify_geometry(geometry, tolerance):
+    # type: (dict, float) -> dict
+    geometry_type = geometry['type']
+    if geometry_type == 'GeometryCollection':
+        return {'type': geometry_type,
+                'geometries': [simplify_geometry(g, tolerance) for g in geometry['geometries']]}
+    if geometry_type == 'LineString':
+        coordinates = simplify_coordinates(geometry['coordinates'], tolerance)
+    elif geometry_type == 'MultiLineString':
+        coordinates = [simplify_coordinates(line, tolerance) for line in geometry['coordinates']]
+    elif geometry_type == 'Polygon':
+        coordinates = [_simplify_ring(ring, tolerance) for ring in geometry['coordinates']]
+    elif geometry_type == 'MultiPolygon':
+        coordinates = [[_simplify_ring(ring, tolerance) for ring in polygon] for polygon in geometry['coordinates']]
+    else:
+        return geometry
+    return {'type': geometry_type, 'coordinates': coordinates}
+
+
+def count_vertices(geometry):
+    # type: (dict) -> int
+    if geometry['type'] == 'GeometryCollection':
+        return sum(count_vertices(g) for g in geometry['geometries'])
+    return _count_coordinates(geometry.get('coordinates') or [])
+
+
+def _count_coordinates(coordinates):
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        return 1
+    return sum(_count_coordinates(c) for c in coordinates)
+
+
+def _simplify_ring(ring, tolerance):
+    # type: (List[List[float]], float) -> List[List[float]]
+    simplified = simplify_coordinates(ring, tolerance)
+    # A ring needs at least 4 points, keep the original when it would collapse
+    return simplified if len(simplified) >= 4 else ring
+
+
+def simplify_coordinates(coordinates, tolerance):
+    # type: (List[List[float]], float) -> List[List[float]]
+    # Douglas-Peucker, iterative to avoid hitting the recursion limit on long lines
+    count = len(coordinates)
+    if count < 3:
+        return coordinates
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    max_distance = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coordinates[first][0], coordinates[first][1]
+        dx = coordinates[last][0] - x1
+        dy = coordinates[last][1] - y1
+        length = dx * dx + dy * dy
+        furthest_distance = 0
+        furthest_index = None
+        for i in xrange(first + 1, last):
+            x, y = coordinates[i][0] - x1, coordinates[i][1] - y1
+            if length:
+                t = (x * dx + y * dy) / length
+                if t > 1:
+                    t = 1
+                elif t < 0:
+                    t = 0
+                x -= t * dx
+                y -= t * dy
+            distance = x * x + y * y
+            if distance > furthest_distance:
+                furthest_distance = distance
+                furthest_index = i
+        if furthest_distance > max_distance:
+            keep[furthest_index] = True
+            stack.append((first, furthest_index))
+            stack.append((furthest_index, last))
+    return [c for c, k in zip(coordinates, keep) if k]
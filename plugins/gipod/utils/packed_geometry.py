@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import array
+import itertools
+import struct
+import sys
+
+from typing import List, Tuple
+
+# Geometries are stored as arrays of integers instead of nested lists of floats:
+#   header: version, amount of geometries
+#   geometry: type, then for a GeometryCollection the amount of geometries followed by those geometries,
+#             for other types the amount of parts, rings and points followed by the part offsets (index of the first
+#             ring of every part), ring offsets (index of the first point of every ring) and the coordinates as
+#             lon, lat pairs in micro degrees.
+# A LineString has 1 part with 1 ring, a MultiLineString and a Polygon have 1 part with a ring per line.
+VERSION = 1
+FACTOR = 1000000  # micro degrees, the same precision as the cleaned coordinates
+
+GEOMETRY_COLLECTION = 'GeometryCollection'
+GEOMETRY_TYPES = ['LineString', 'MultiLineString', 'Polygon', 'MultiPolygon', GEOMETRY_COLLECTION]
+
+_HEADER = struct.Struct('<BH')
+_TYPE = struct.Struct('<B')
+_COUNT = struct.Struct('<I')
+_COUNTS = struct.Struct('<III')
+# Arrays use the byte order of the machine, the packed data is always little endian
+_SWAP_BYTES = sys.byteorder != 'little'
+
+
+class PackedGeometry(object):
+    __slots__ = ('type', 'geometries', 'part_offsets', 'ring_offsets', 'coordinates')
+
+    def __init__(self, type_, geometries=None, part_offsets=None, ring_offsets=None, coordinates=None):
+        self.type = type_
+        self.geometries = geometries  # type: List[PackedGeometry]
+        self.part_offsets = part_offsets  # type: array.array
+        self.ring_offsets = ring_offsets  # type: array.array
+        self.coordinates = coordinates  # type: array.array
+
+    @property
+    def part_count(self):
+        return len(self.part_offsets) - 1
+
+    def get_rings(self, part):
+        # type: (int) -> List[List[Tuple[float, float]]]
+        return [self.get_ring(ring) for ring in xrange(self.part_offsets[part], self.part_offsets[part + 1])]
+
+    def get_ring(self, ring):
+        # type: (int) -> List[Tuple[float, float]]
+        # lon, lat pairs in degrees
+        start = self.ring_offsets[ring] * 2
+        end = self.ring_offsets[ring + 1] * 2
+        coordinates = self.coordinates
+        factor = float(FACTOR)
+        return [(lon / factor, lat / factor) for lon, lat in
+                itertools.izip(coordinates[start:end:2], coordinates[start + 1:end:2])]
+
+
+def can_pack_geometry(geometry):
+    # type: (dict) -> bool
+    if not geometry or geometry.get('type') not in GEOMETRY_TYPES:
+        return False
+    if geometry['type'] == GEOMETRY_COLLECTION:
+        return all(g.get('type') not in (None, GEOMETRY_COLLECTION) and can_pack_geometry(g)
+                   for g in geometry.get('geometries') or [])
+    return isinstance(geometry.get('coordinates'), list)
+
+
+def pack_geometries(geometries):
+    # type: (List[dict]) -> str
+    # GeoJSON geometries, check them with can_pack_geometry first
+    chunks = [_HEADER.pack(VERSION, len(geometries))]
+    for geometry in geometries:
+        _pack_geometry(geometry, chunks)
+    return ''.join(chunks)
+
+
+def _pack_geometry(geometry, chunks):
+    # type: (dict, List[str]) -> None
+    geometry_type = geometry['type']
+    chunks.append(_TYPE.pack(GEOMETRY_TYPES.index(geometry_type)))
+    if geometry_type == GEOMETRY_COLLECTION:
+        chunks.append(_COUNT.pack(len(geometry['geometries'])))
+        for g in geometry['geometries']:
+            _pack_geometry(g, chunks)
+        return
+    if geometry_type == 'LineString':
+        parts = [[geometry['coordinates']]]
+    elif geometry_type in ('MultiLineString', 'Polygon'):
+        parts = [geometry['coordinates']]
+    else:
+        parts = geometry['coordinates']
+    part_offsets = array.array('I', [0])
+    ring_offsets = array.array('I', [0])
+    values = []
+    for rings in parts:
+        for ring in rings:
+            # Flattened to one list so the whole geometry is converted at once
+            values.extend(itertools.chain.from_iterable(point[:2] for point in ring))
+            ring_offsets.append(len(values) / 2)
+        part_offsets.append(len(ring_offsets) - 1)
+    coordinates = array.array('i', [int(round(value * FACTOR)) for value in values])
+    chunks.append(_COUNTS.pack(len(part_offsets) - 1, len(ring_offsets) - 1, len(coordinates) / 2))
+    for values_array in (part_offsets, ring_offsets, coordinates):
+        if _SWAP_BYTES:
+            values_array.byteswap()
+        chunks.append(values_array.tostring())
+
+
+def unpack_geometries(packed):
+    # type: (str) -> List[PackedGeometry]
+    version, count = _HEADER.unpack_from(packed, 0)
+    if version != VERSION:
+        raise Exception('Unsupported packed geometry version %s' % version)
+    offset = _HEADER.size
+    geometries = []
+    for _ in xrange(count):
+        geometry, offset = _unpack_geometry(packed, offset)
+        geometries.append(geometry)
+    return geometries
+
+
+def _unpack_geometry(packed, offset):
+    # type: (str, int) -> Tuple[PackedGeometry, int]
+    geometry_type = GEOMETRY_TYPES[_TYPE.unpack_from(packed, offset)[0]]
+    offset += _TYPE.size
+    if geometry_type == GEOMETRY_COLLECTION:
+        count = _COUNT.unpack_from(packed, offset)[0]
+        offset += _COUNT.size
+        geometries = []
+        for _ in xrange(count):
+            geometry, offset = _unpack_geometry(packed, offset)
+            geometries.append(geometry)
+        return PackedGeometry(geometry_type, geometries=geometries), offset
+    part_count, ring_count, point_count = _COUNTS.unpack_from(packed, offset)
+    offset += _COUNTS.size
+    part_offsets, offset = _unpack_array(packed, offset, 'I', part_count + 1)
+    ring_offsets, offset = _unpack_array(packed, offset, 'I', ring_count + 1)
+    coordinates, offset = _unpack_array(packed, offset, 'i', point_count * 2)
+    return PackedGeometry(geometry_type, part_offsets=part_offsets, ring_offsets=ring_offsets,
+                          coordinates=coordinates), offset
+
+
+def _unpack_array(packed, offset, type_code, length):
+    # type: (str, int, str, int) -> Tuple[array.array, int]
+    values = array.array(type_code)
+    end = offset + values.itemsize * length
+    values.fromstring(packed[offset:end])
+    if _SWAP_BYTES:
+        values.byteswap()
+    return values, end
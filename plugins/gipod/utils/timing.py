@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import json
+import logging
+import random
+import threading
+import timeit
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from typing import Iterable, Dict
+
+from plugins.gipod.plugin_consts import TIMING_SAMPLE_RATE
+
+_local = threading.local()
+
+
+class RequestTimer(object):
+    # Collects how long the phases of a request took, and some counts and sizes (hits, bytes, ...).
+    # Disabled timers ignore everything, so the instrumentation is nearly free for requests that aren't sampled.
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = OrderedDict()  # type: Dict[str, float]
+        self.counts = {}  # type: Dict[str, long]
+        self.start = timeit.default_timer()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add_duration(name, timeit.default_timer() - start)
+
+    def add_duration(self, name, duration):
+        # type: (str, float) -> None
+        # Durations of a phase that runs several times (e.g. once per item) are added up
+        if self.enabled:
+            self.phases[name] = self.phases.get(name, 0) + duration
+
+    def count(self, name, value=1):
+        # type: (str, long) -> None
+        if self.enabled:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def timed_iter(self, name, iterable):
+        # type: (str, Iterable) -> Iterable
+        # Measures the time spent producing the items of a lazy iterable, e.g. a generator converting models
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = timeit.default_timer()
+            try:
+                item = next(iterator)
+            finally:
+                self.add_duration(name, timeit.default_timer() - start)
+            yield item
+
+    def get_server_timing_header(self):
+        # type: () -> str
+        metrics = ['%s;dur=%.1f' % (name, duration * 1000) for name, duration in self.phases.iteritems()]
+        metrics.append('total;dur=%.1f' % ((timeit.default_timer() - self.start) * 1000))
+        return ', '.join(metrics)
+
+    def log(self, path):
+        # type: (str) -> None
+        record = {
+            'path': path,
+            'total_ms': round((timeit.default_timer() - self.start) * 1000, 1),
+            'phases_ms': {name: round(duration * 1000, 1) for name, duration in self.phases.iteritems()},
+            'counts': self.counts,
+        }
+        logging.info('request timing: %s', json.dumps(record, sort_keys=True))
+
+
+_disabled_timer = RequestTimer(enabled=False)
+
+
+def start_request_timer():
+    # type: () -> RequestTimer
+    timer = RequestTimer(enabled=random.random() < TIMING_SAMPLE_RATE)
+    _local.timer = timer
+    return timer
+
+
+def stop_request_timer():
+    _local.timer = None
+
+
+def get_request_timer():
+    # type: () -> RequestTimer
+    # Timer of the current request, or a disabled one when it isn't sampled or there is no request (e.g. in tasks)
+    return getattr(_local, 'timer', None) or _disabled_timer
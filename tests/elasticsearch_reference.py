@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import calendar
+import math
+from collections import Counter
+from datetime import datetime
+
+# Straightforward implementation of the parts of the elasticsearch query dsl that the elasticsearch backend uses,
+# following the elasticsearch documentation. It evaluates the filters and sort of the queries created by
+# elasticsearch._get_search_filters and _get_search_sort on every document, so the results of other search backends
+# can be compared with what elasticsearch returns.
+
+EARTH_MEAN_RADIUS = 6371008.7714  # meters, used by the arc distance of elasticsearch
+MAX_LATITUDE = 85.0511287798066  # web mercator limit of the geotile grid
+
+
+def parse_date(value):
+    # type: (str) -> long
+    # Milliseconds since epoch, like elasticsearch stores dates. Only the formats used by the api and the documents.
+    value = value.rstrip('Z')
+    for date_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            d = datetime.strptime(value, date_format)
+            return calendar.timegm(d.utctimetuple()) * 1000
+        except ValueError:
+            pass
+    raise ValueError('Unsupported date: %s' % value)
+
+
+def arc_distance(lat1, lon1, lat2, lon2):
+    # type: (float, float, float, float) -> float
+    lat1, lon1, lat2, lon2 = [math.radians(value) for value in (lat1, lon1, lat2, lon2)]
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_MEAN_RADIUS * 2 * math.asin(min(1.0, math.sqrt(h)))
+
+
+def geotile(lat, lon, precision):
+    # type: (float, float, int) -> str
+    # Same as GeoTileUtils.longEncode of elasticsearch
+    tiles = 1 << precision
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    x = int(math.floor((lon + 180) / 360 * tiles))
+    lat_sin = math.sin(math.radians(lat))
+    y = int(math.floor((0.5 - math.log((1 + lat_sin) / (1 - lat_sin)) / (4 * math.pi)) * tiles))
+    return '%d/%d/%d' % (precision, min(max(x, 0), tiles - 1), min(max(y, 0), tiles - 1))
+
+
+def matches(doc, filters):
+    # type: (dict, list) -> bool
+    return all(_matches_filter(doc, query_filter) for query_filter in filters)
+
+
+def _matches_filter(doc, query_filter):
+    if 'geo_distance' in query_filter:
+        options = query_filter['geo_distance']
+        distance = float(options['distance'].rstrip('m'))
+        point = options['location']
+        return arc_distance(point['lat'], point['lon'], doc['location']['lat'], doc['location']['lon']) <= distance
+    if 'geo_bounding_box' in query_filter:
+        box = query_filter['geo_bounding_box']['location']
+        lat, lon = doc['location']['lat'], doc['location']['lon']
+        return box['bottom_right']['lat'] <= lat <= box['top_left']['lat'] \
+            and box['top_left']['lon'] <= lon <= box['bottom_right']['lon']
+    if 'range' in query_filter:
+        field, options = query_filter['range'].items()[0]
+        if field == 'time_frames':
+            # date_range field, a document matches when one of its ranges matches
+            return any(_range_matches(parse_date(frame['gte']), parse_date(frame['lte']), options)
+                       for frame in doc['time_frames'])
+        # date field, relation is ignored
+        value = parse_date(doc[field])
+        return _range_matches(value, value, options)
+    raise Exception('Unsupported filter: %s' % query_filter.keys())
+
+
+def _range_matches(start, end, options):
+    # type: (long, long, dict) -> bool
+    # Whether the range start - end (inclusive) matches the range query
+    query_start = parse_date(options['gte']) if options.get('gte') else None
+    query_end = None
+    end_inclusive = True
+    if options.get('lte'):
+        query_end = parse_date(options['lte'])
+    elif options.get('lt'):
+        query_end = parse_date(options['lt'])
+        end_inclusive = False
+    if options.get('relation', 'intersects') == 'within':
+        after_start = query_start is None or start >= query_start
+        before_end = query_end is None or (end <= query_end if end_inclusive else end < query_end)
+        return after_start and before_end
+    after_start = query_start is None or end >= query_start
+    before_end = query_end is None or (start <= query_end if end_inclusive else start < query_end)
+    return after_start and before_end
+
+
+def get_sort_values(doc, sort):
+    # type: (dict, list) -> list
+    values = []
+    for sort_option in sort:
+        field, options = sort_option.items()[0]
+        if options.get('order', 'asc') != 'asc':
+            raise Exception('Only ascending sorts are supported')
+        if field == '_geo_distance':
+            point = options['location']
+            values.append(arc_distance(point['lat'], point['lon'], doc['location']['lat'], doc['location']['lon']))
+        elif field == 'start_date':
+            values.append(parse_date(doc['start_date']))
+        else:
+            values.append(doc[field])
+    return values
+
+
+def search(documents, query):
+    # type: (list, dict) -> list
+    # documents: (uid, document) tuples. Returns the hits with their sort values, like elasticsearch.
+    filters = query['query']['bool']['filter']
+    hits = [{'_id': uid, '_source': doc, 'sort': get_sort_values(doc, query['sort'])}
+            for uid, doc in documents if matches(doc, filters)]
+    hits.sort(key=lambda hit: hit['sort'])
+    if query.get('search_after'):
+        hits = [hit for hit in hits if hit['sort'] > query['search_after']]
+    start = query.get('from', 0)
+    return hits[start:start + query['size']]
+
+
+def geotile_grid(documents, filters, precision):
+    # type: (list, list, int) -> dict
+    # Returns the buckets per key, with the amount of documents, their centroid and the most common icon
+    tiles = {}
+    for _, doc in documents:
+        if matches(doc, filters):
+            tile = geotile(doc['location']['lat'], doc['location']['lon'], precision)
+            tiles.setdefault(tile, []).append(doc)
+    buckets = {}
+    for key, docs in tiles.iteritems():
+        icons = Counter(doc['icon']['id'] for doc in docs)
+        # terms aggregations are ordered on count, then on the term
+        top_icon = sorted(icons.iteritems(), key=lambda icon: (-icon[1], icon[0]))[0]
+        buckets[key] = {
+            'doc_count': len(docs),
+            'lat': sum(doc['location']['lat'] for doc in docs) / len(docs),
+            'lon': sum(doc['location']['lon'] for doc in docs) / len(docs),
+            'icon': top_icon,
+        }
+    return buckets
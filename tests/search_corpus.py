@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+from plugins.gipod.bizz.search import index_doc_operations
+from plugins.gipod.models import ItemFilterType, ItemSort
+
+# Fixed set of documents shared by the search backend tests. It contains the edge cases of the queries: items on the
+# same location or with the same start date (sorted on uid, as strings), time frames that end exactly on the start of
+# a query, items with several time frames and items far away from the others.
+CENTER = (51.05, 3.73)
+
+# uid, lat, lon, icon id, time frames
+ITEMS = [
+    ('w-1', 51.05, 3.73, 'a', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+    ('w-2', 51.05, 3.73, 'a', [('2020-01-01T00:00:00', '2020-03-01T00:00:00')]),
+    ('w-3', 51.055, 3.73, 'b', [('2020-02-01T00:00:00', '2020-02-10T00:00:00')]),
+    ('w-4', 51.06, 3.74, 'c', [('2019-12-01T00:00:00', '2020-01-01T00:00:00')]),
+    ('m-5', 51.045, 3.725, 'a', [('2020-01-05T00:00:00', '2020-01-06T00:00:00'),
+                                 ('2020-03-01T00:00:00', '2020-03-02T00:00:00')]),
+    ('m-6', 51.07, 3.73, 'b', [('2020-01-15T08:00:00', '2020-01-20T17:00:00')]),
+    ('w-7', 51.1, 3.73, 'a', [('2020-01-01T00:00:00', '2020-12-31T00:00:00')]),
+    ('w-8', 51.05, 3.8, 'c', [('2020-06-01T00:00:00', '2020-06-30T00:00:00')]),
+    ('m-9', 51.05, 3.65, 'a', [('2020-01-31T12:00:00', '2020-02-01T00:00:00')]),
+    ('w-10', 51.2, 3.73, 'b', [('2020-01-01T00:00:00', '2020-01-02T00:00:00')]),
+    ('w-11', 50.9, 3.5, 'a', [('2020-01-10T00:00:00', '2020-01-11T00:00:00')]),
+    ('w-12', 51.052, 3.732, 'c', [('2020-02-01T00:00:00', '2020-02-05T00:00:00')]),
+    ('m-13', 51.048, 3.728, 'b', [('2019-11-01T00:00:00', '2019-11-02T00:00:00'),
+                                  ('2020-01-20T00:00:00', '2020-01-21T00:00:00')]),
+    ('w-14', 51.03, 3.71, 'a', [('2021-01-01T00:00:00', '2021-01-10T00:00:00')]),
+    ('w-20', 51.04, 3.74, 'b', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+    ('w-100', 51.04, 3.74, 'c', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+    ('m-15', 50.85, 4.35, 'b', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+    ('m-16', 50.851, 4.351, 'c', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+    ('m-17', 50.849, 4.352, 'c', [('2020-01-01T00:00:00', '2020-01-31T00:00:00')]),
+]
+
+GHENT_BBOX = {'north': 51.08, 'east': 3.76, 'south': 51.02, 'west': 3.7}
+BELGIUM_BBOX = {'north': 51.6, 'east': 6.5, 'south': 49.4, 'west': 2.5}
+
+# lat, lon, distance, start, end, filter_type, bbox, sort
+QUERIES = [
+    (CENTER[0], CENTER[1], 1000, '2020-01-01T00:00:00Z', '2020-01-31T00:00:00Z', ItemFilterType.RANGE, None, None),
+    (CENTER[0], CENTER[1], 6000, '2020-01-01T00:00:00Z', None, ItemFilterType.RANGE, None, None),
+    (CENTER[0], CENTER[1], 6000, '2020-01-01', '2020-01-31', ItemFilterType.RANGE, None, ItemSort.START_DATE),
+    (CENTER[0], CENTER[1], 30000, '2020-01-01T00:00:00Z', '2020-02-01T00:00:00Z', ItemFilterType.START_DATE, None,
+     None),
+    (CENTER[0], CENTER[1], 30000, '2020-01-31T00:00:00Z', '2020-01-31T00:00:00Z', ItemFilterType.RANGE, None,
+     ItemSort.NONE),
+    (None, None, None, '2019-01-01T00:00:00Z', None, ItemFilterType.RANGE, GHENT_BBOX, None),
+    (None, None, None, '2020-01-01T00:00:00Z', '2020-02-01T00:00:00Z', ItemFilterType.START_DATE, GHENT_BBOX,
+     ItemSort.START_DATE),
+    (CENTER[0], CENTER[1], None, '2020-01-01T00:00:00Z', None, ItemFilterType.RANGE, GHENT_BBOX, ItemSort.DISTANCE),
+    (None, None, None, '2019-01-01T00:00:00Z', None, ItemFilterType.RANGE, BELGIUM_BBOX, None),
+]
+
+
+def create_document(uid, lat, lon, icon_id, time_frames):
+    # Same fields as the documents created by gipod._index_item
+    frames = [{'gte': start + 'Z', 'lte': end + 'Z'} for start, end in time_frames]
+    return {
+        'uid': uid,
+        'location': {
+            'lat': lat,
+            'lon': lon
+        },
+        'start_date': frames[0]['gte'],
+        'end_date': frames[0]['lte'],
+        'time_frames': frames,
+        'title': 'Item %s' % uid,
+        'icon': {
+            'id': icon_id,
+            'color': '#000000'
+        },
+        'periods': [],
+    }
+
+
+def get_documents():
+    return [(item[0], create_document(*item)) for item in ITEMS]
+
+
+def get_index_operations():
+    for uid, doc in get_documents():
+        for operation in index_doc_operations(uid, doc):
+            yield operation
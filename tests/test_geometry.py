@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import unittest
+
+from plugins.gipod.utils.geometry import encode_polyline, simplify_coordinates, simplify_geometry, count_vertices
+
+
+class EncodePolylineTest(unittest.TestCase):
+
+    def test_known_polyline(self):
+        # Example of the encoded polyline algorithm format documentation of Google, as lon, lat pairs
+        coordinates = [[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]]
+        self.assertEqual('_p~iF~ps|U_ulLnnqC_mqNvxq`@', encode_polyline(coordinates))
+
+    def test_precision(self):
+        self.assertEqual('_izlhA~rlgdF_{geC~ywl@_kwzCn`{nI',
+                         encode_polyline([[-120.2, 38.5], [-120.95, 40.7], [-126.453, 43.252]], precision=6))
+
+    def test_rounding(self):
+        # Values are rounded to the precision, not truncated, so the deltas never drift
+        self.assertEqual(encode_polyline([[3.0, 51.0], [3.00001, 51.00001]]),
+                         encode_polyline([[2.999996, 50.999996], [3.000014, 51.000006]]))
+
+    def test_empty(self):
+        self.assertEqual('', encode_polyline([]))
+
+
+class SimplifyTest(unittest.TestCase):
+
+    def test_short_lines(self):
+        for coordinates in ([], [[3.0, 51.0]], [[3.0, 51.0], [3.1, 51.1]]):
+            self.assertEqual(coordinates, simplify_coordinates(coordinates, 1))
+
+    def test_straight_line(self):
+        coordinates = [[3.0 + i * 0.001, 51.0] for i in range(100)]
+        self.assertEqual([coordinates[0], coordinates[-1]], simplify_coordinates(coordinates, 0.0001))
+
+    def test_tolerance(self):
+        coordinates = [[0.0, 0.0], [1.0, 0.05], [2.0, 0.0], [3.0, 1.0], [4.0, 0.0]]
+        # The point at 0.05 from the line is only kept when the tolerance is smaller than that
+        self.assertEqual([[0.0, 0.0], [2.0, 0.0], [3.0, 1.0], [4.0, 0.0]], simplify_coordinates(coordinates, 0.1))
+        self.assertEqual(coordinates, simplify_coordinates(coordinates, 0.01))
+        self.assertEqual([[0.0, 0.0], [4.0, 0.0]], simplify_coordinates(coordinates, 2))
+
+    def test_closed_ring(self):
+        # First and last point are the same, distances are measured to that point
+        ring = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.0, 0.0]]
+        self.assertEqual(ring, simplify_coordinates(ring, 0.5))
+
+    def test_long_line(self):
+        # Deeper than the recursion limit
+        coordinates = [[i * 0.001, (i % 2) * 0.001 + i * 0.0001] for i in range(5000)]
+        simplified = simplify_coordinates(coordinates, 0.00001)
+        self.assertEqual(coordinates, simplified)
+
+    def test_geometries(self):
+        line = [[0.0, 0.0], [1.0, 0.001], [2.0, 0.0]]
+        small_ring = [[0.0, 0.0], [0.001, 0.0], [0.001, 0.001], [0.0, 0.0]]
+        ring = [[0.0, 0.0], [1.0, 0.001], [2.0, 0.0], [2.0, 2.0], [0.0, 2.0], [0.0, 0.0]]
+        simplified_ring = [[0.0, 0.0], [2.0, 0.0], [2.0, 2.0], [0.0, 2.0], [0.0, 0.0]]
+        point = {'type': 'Point', 'coordinates': [1.0, 1.0]}
+        self.assertIs(point, simplify_geometry(point, 0.1))
+        self.assertEqual({'type': 'LineString', 'coordinates': [[0.0, 0.0], [2.0, 0.0]]},
+                         simplify_geometry({'type': 'LineString', 'coordinates': line}, 0.1))
+        self.assertEqual({'type': 'MultiLineString', 'coordinates': [[[0.0, 0.0], [2.0, 0.0]], []]},
+                         simplify_geometry({'type': 'MultiLineString', 'coordinates': [line, []]}, 0.1))
+        # Rings that would collapse are kept as they are
+        self.assertEqual({'type': 'Polygon', 'coordinates': [simplified_ring, small_ring]},
+                         simplify_geometry({'type': 'Polygon', 'coordinates': [ring, small_ring]}, 0.1))
+        self.assertEqual({'type': 'MultiPolygon', 'coordinates': [[simplified_ring], []]},
+                         simplify_geometry({'type': 'MultiPolygon', 'coordinates': [[ring], []]}, 0.1))
+        collection = {'type': 'GeometryCollection', 'geometries': [
+            point,
+            {'type': 'LineString', 'coordinates': line},
+            {'type': 'GeometryCollection', 'geometries': [{'type': 'Polygon', 'coordinates': [ring]}]},
+        ]}
+        self.assertEqual({'type': 'GeometryCollection', 'geometries': [
+            point,
+            {'type': 'LineString', 'coordinates': [[0.0, 0.0], [2.0, 0.0]]},
+            {'type': 'GeometryCollection', 'geometries': [{'type': 'Polygon', 'coordinates': [simplified_ring]}]},
+        ]}, simplify_geometry(collection, 0.1))
+        self.assertEqual(1 + 3 + 6, count_vertices(collection))
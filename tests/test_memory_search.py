@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import unittest
+
+from plugins.gipod.bizz.elasticsearch import _get_search_filters, _get_search_sort
+from plugins.gipod.bizz.memory_search import MemorySearchBackend
+from plugins.gipod.bizz.search import MAP_ITEM_SOURCE_FIELDS, create_cursor, parse_cursor, get_cluster_precision
+from plugins.gipod.models import ItemFilterType
+from tests import elasticsearch_reference
+from tests.search_corpus import QUERIES, CENTER, GHENT_BBOX, BELGIUM_BBOX, get_documents, get_index_operations
+
+
+def _create_query(lat, lon, distance, start, end, filter_type, bbox, sort, size, cursor=None):
+    # The query the elasticsearch backend sends for these parameters
+    start_offset, search_after = parse_cursor(cursor)
+    query = {
+        'size': size,
+        'query': {
+            'bool': {
+                'filter': _get_search_filters(lat, lon, distance, start, end, filter_type, bbox)
+            }
+        },
+        'sort': _get_search_sort(lat, lon, bbox, sort)
+    }
+    if search_after is None:
+        query['from'] = start_offset
+    else:
+        query['search_after'] = search_after
+    return query
+
+
+class MemorySearchBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MemorySearchBackend(loader=lambda: list(get_index_operations()))
+        self.documents = get_documents()
+
+    def search(self, query, cursor=None, limit=100, source=False):
+        lat, lon, distance, start, end, filter_type, bbox, sort = query
+        return self.backend.search_items(lat, lon, distance, start, end, cursor, limit, filter_type, source, bbox,
+                                         sort)
+
+    def search_reference(self, query, cursor=None, limit=100):
+        return elasticsearch_reference.search(self.documents, _create_query(*(query + (limit, cursor))))
+
+    def assertSameHits(self, expected_hits, hits, message=None):
+        self.assertEqual([hit['_id'] for hit in expected_hits], [hit['_id'] for hit in hits], message)
+        for expected, hit in zip(expected_hits, hits):
+            self.assertEqual(len(expected['sort']), len(hit['sort']))
+            for expected_value, value in zip(expected['sort'], hit['sort']):
+                if isinstance(expected_value, float):
+                    self.assertAlmostEqual(expected_value, value, places=3)
+                else:
+                    self.assertEqual(expected_value, value)
+
+    def test_filters_and_sort(self):
+        for query in QUERIES:
+            _, hits = self.search(query)
+            self.assertSameHits(self.search_reference(query), hits, query)
+
+    def test_known_results(self):
+        # Checked by hand, to make sure the reference implementation isn't wrong in the same way
+        query = (CENTER[0], CENTER[1], 1000, '2020-01-01T00:00:00Z', '2020-01-31T00:00:00Z', ItemFilterType.RANGE,
+                 None, None)
+        _, hits = self.search(query)
+        # Same distance and start date, so sorted on uid. w-4 ends on the start of the query.
+        self.assertEqual(['w-1', 'w-2', 'm-13', 'm-5'], [hit['_id'] for hit in hits])
+
+        # start_date: only the start date of the first time frame counts, the end is exclusive
+        query = (None, None, None, '2020-01-01T00:00:00Z', '2020-02-01T00:00:00Z', ItemFilterType.START_DATE,
+                 GHENT_BBOX, None)
+        _, hits = self.search(query)
+        self.assertEqual(['m-5', 'm-6', 'w-1', 'w-100', 'w-2', 'w-20'], [hit['_id'] for hit in hits])
+
+    def test_paging(self):
+        for query in QUERIES:
+            expected_ids = [hit['_id'] for hit in self.search_reference(query)]
+            for limit in (1, 2, 3):
+                ids = []
+                cursor = None
+                while True:
+                    new_cursor, hits = self.search(query, cursor, limit)
+                    self.assertSameHits(self.search_reference(query, cursor, limit), hits, (query, limit))
+                    ids.extend(hit['_id'] for hit in hits)
+                    cursor = new_cursor
+                    if not cursor:
+                        break
+                self.assertEqual(expected_ids, ids, (query, limit))
+
+    def test_search_after_pages(self):
+        for query in QUERIES:
+            all_hits = self.search_reference(query)
+            for i, hit in enumerate(all_hits):
+                cursor = create_cursor(hit['sort'])
+                _, hits = self.search(query, cursor, 2)
+                self.assertSameHits(self.search_reference(query, cursor, 2), hits, query)
+                self.assertSameHits(all_hits[i + 1:i + 3], hits, query)
+
+    def test_offset_cursor(self):
+        # Cursors created before search_after was used
+        query = QUERIES[1]
+        _, hits = self.search(query, '2', 3)
+        self.assertSameHits(self.search_reference(query, '2', 3), hits)
+
+    def test_source(self):
+        query = QUERIES[0]
+        _, hits = self.search(query, source=MAP_ITEM_SOURCE_FIELDS)
+        self.assertTrue(hits)
+        for hit in hits:
+            self.assertEqual(sorted(MAP_ITEM_SOURCE_FIELDS), sorted(hit['_source'].keys()))
+        _, hits = self.search(query, source=False)
+        self.assertEqual([None] * len(hits), [hit['_source'] for hit in hits])
+
+    def test_clusters(self):
+        for bbox in (GHENT_BBOX, BELGIUM_BBOX):
+            for filter_type, start, end in ((ItemFilterType.RANGE, '2020-01-01T00:00:00Z', None),
+                                            (ItemFilterType.START_DATE, '2020-01-01T00:00:00Z',
+                                             '2020-02-01T00:00:00Z')):
+                for zoom in (3, 8, 12, 15, 18):
+                    buckets = self.backend.search_clusters(None, None, None, start, end, zoom, filter_type, bbox)
+                    filters = _get_search_filters(None, None, None, start, end, filter_type, bbox)
+                    expected = elasticsearch_reference.geotile_grid(self.documents, filters,
+                                                                    get_cluster_precision(zoom))
+                    message = (bbox, filter_type, zoom)
+                    self.assertEqual(sorted(expected.keys()), sorted(bucket['key'] for bucket in buckets), message)
+                    counts = [bucket['doc_count'] for bucket in buckets]
+                    self.assertEqual(sorted(counts, reverse=True), counts, message)
+                    for bucket in buckets:
+                        expected_bucket = expected[bucket['key']]
+                        self.assertEqual(expected_bucket['doc_count'], bucket['doc_count'], message)
+                        self.assertAlmostEqual(expected_bucket['lat'], bucket['centroid']['location']['lat'], 6)
+                        self.assertAlmostEqual(expected_bucket['lon'], bucket['centroid']['location']['lon'], 6)
+                        icon_bucket = bucket['icons']['buckets'][0]
+                        self.assertEqual(expected_bucket['icon'], (icon_bucket['key'], icon_bucket['doc_count']),
+                                         message)
+
+    def test_bulk_operations(self):
+        query = QUERIES[0]
+        self.search(query)
+        items = self.backend.execute_bulk_request([{'delete': {'_id': 'w-1'}}, {'delete': {'_id': 'w-1'}}])
+        self.assertEqual([200, 404], [item['delete']['status'] for item in items])
+        _, hits = self.search(query)
+        self.assertNotIn('w-1', [hit['_id'] for hit in hits])
+        self.documents = [(uid, doc) for uid, doc in self.documents if uid != 'w-1']
+        self.assertSameHits(self.search_reference(query), hits)
+
+    def test_bulk_operations_without_index(self):
+        loads = []
+        backend = MemorySearchBackend(loader=lambda: loads.append(1) or list(get_index_operations()))
+        items = backend.execute_bulk_request([{'delete': {'_id': 'w-1'}}])
+        self.assertEqual([200], [item['delete']['status'] for item in items])
+        self.assertEqual([], loads)
+
+    def test_bulk_operations_while_loading(self):
+        # Operations received while the index is loading are applied to the new index
+        def loader():
+            for operation in get_index_operations():
+                yield operation
+            self.backend.execute_bulk_request([{'delete': {'_id': 'w-1'}}])
+
+        self.backend = MemorySearchBackend(loader=loader)
+        _, hits = self.search(QUERIES[0])
+        self.assertNotIn('w-1', [hit['_id'] for hit in hits])
+        self.documents = [(uid, doc) for uid, doc in self.documents if uid != 'w-1']
+        self.assertSameHits(self.search_reference(QUERIES[0]), hits)
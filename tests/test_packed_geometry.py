@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 Green Valley Belgium NV
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# @@license_version:1.5@@
+
+import unittest
+
+from plugins.gipod.utils.packed_geometry import pack_geometries, unpack_geometries, can_pack_geometry, \
+    GEOMETRY_COLLECTION
+
+LINE = [[3.725123, 51.051234], [3.73, 51.05], [-0.000001, -89.999999]]
+RING = [[3.72, 51.05], [3.73, 51.05], [3.73, 51.06], [3.72, 51.05]]
+HOLE = [[3.725, 51.052], [3.726, 51.052], [3.726, 51.053], [3.725, 51.052]]
+
+
+def _to_geojson(geometry):
+    # Reverse of pack_geometries
+    if geometry.type == GEOMETRY_COLLECTION:
+        return {'type': geometry.type, 'geometries': [_to_geojson(g) for g in geometry.geometries]}
+    parts = [[[list(point) for point in ring] for ring in geometry.get_rings(part)]
+             for part in xrange(geometry.part_count)]
+    if geometry.type == 'LineString':
+        coordinates = parts[0][0]
+    elif geometry.type in ('MultiLineString', 'Polygon'):
+        coordinates = parts[0]
+    else:
+        coordinates = parts
+    return {'type': geometry.type, 'coordinates': coordinates}
+
+
+class PackedGeometryTest(unittest.TestCase):
+
+    def assertRoundTrip(self, geometries):
+        self.assertTrue(all(can_pack_geometry(g) for g in geometries))
+        unpacked = [_to_geojson(g) for g in unpack_geometries(pack_geometries(geometries))]
+        self.assertEqual(geometries, unpacked)
+
+    def test_geometry_types(self):
+        self.assertRoundTrip([
+            {'type': 'LineString', 'coordinates': LINE},
+            {'type': 'MultiLineString', 'coordinates': [LINE, LINE[:2]]},
+            {'type': 'Polygon', 'coordinates': [RING, HOLE]},
+            {'type': 'MultiPolygon', 'coordinates': [[RING, HOLE], [RING]]},
+        ])
+
+    def test_empty_parts(self):
+        self.assertRoundTrip([
+            {'type': 'LineString', 'coordinates': []},
+            {'type': 'MultiLineString', 'coordinates': []},
+            {'type': 'MultiLineString', 'coordinates': [[], LINE, []]},
+            {'type': 'Polygon', 'coordinates': [RING, []]},
+            {'type': 'MultiPolygon', 'coordinates': [[], [RING], [[]]]},
+        ])
+        self.assertRoundTrip([])
+
+    def test_geometry_collection(self):
+        self.assertRoundTrip([
+            {'type': GEOMETRY_COLLECTION, 'geometries': [
+                {'type': 'LineString', 'coordinates': LINE},
+                {'type': 'MultiPolygon', 'coordinates': [[RING]]},
+            ]},
+            {'type': GEOMETRY_COLLECTION, 'geometries': []},
+            {'type': 'Polygon', 'coordinates': [RING]},
+        ])
+
+    def test_precision(self):
+        # Rounded to micro degrees, extra dimensions are dropped
+        geometry = {'type': 'LineString', 'coordinates': [[3.12345649, 51.12345651, 12.5], [-3.0000004, -51.0000006]]}
+        unpacked = _to_geojson(unpack_geometries(pack_geometries([geometry]))[0])
+        self.assertEqual({'type': 'LineString', 'coordinates': [[3.123456, 51.123457], [-3.0, -51.000001]]},
+                         unpacked)
+
+    def test_can_pack_geometry(self):
+        self.assertFalse(can_pack_geometry(None))
+        self.assertFalse(can_pack_geometry({'type': 'Point', 'coordinates': [3.7, 51.0]}))
+        self.assertFalse(can_pack_geometry({'type': 'LineString'}))
+        self.assertFalse(can_pack_geometry({'type': GEOMETRY_COLLECTION, 'geometries': [
+            {'type': 'Point', 'coordinates': [3.7, 51.0]}]}))
+        self.assertFalse(can_pack_geometry({'type': GEOMETRY_COLLECTION, 'geometries': [
+            {'type': GEOMETRY_COLLECTION, 'geometries': []}]}))
+        self.assertTrue(can_pack_geometry({'type': GEOMETRY_COLLECTION, 'geometries': []}))
+
+    def test_unsupported_version(self):
+        packed = pack_geometries([{'type': 'LineString', 'coordinates': LINE}])
+        self.assertRaises(Exception, unpack_geometries, '\x02' + packed[1:])